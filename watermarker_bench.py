@@ -0,0 +1,262 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import multiprocessing
+
+EXIT_OK = 0
+EXIT_REGRESSION = 1
+EXIT_INVALID_INPUT = 2
+
+BENCH_FORMAT_VERSION = 1
+DEFAULT_TOLERANCE = 0.10
+# Page kinds and their size at --scale 1.0. Heights are scaled, widths are not.
+PAGE_KINDS = {
+    "flat": (800, 12000),
+    "screentone": (800, 12000),
+    "tall_strip": (800, 60000),
+    "psd_canvas": (2480, 3508),
+    "no_uniform": (800, 12000),
+}
+BATCH_CHAPTERS = 3
+BATCH_PAGES_PER_CHAPTER = 4
+BATCH_PAGE_KINDS = ("flat", "screentone")
+BENCHMARK_GROUPS = ("convert", "search", "add_watermarks", "run_processing")
+
+def noop_status(message): pass
+
+def _panel_rows(rng, height):
+    y = rng.randint(150, 600)
+    while y < height - 200:
+        panel_height = rng.randint(700, 1600); yield y, min(height - 100, y + panel_height); y += panel_height + rng.randint(300, 2500)
+
+def _screentone_band(rng, width, period=8):
+    from PIL import Image, ImageDraw
+    band = Image.new("L", (width, period), 255); draw = ImageDraw.Draw(band); radius = rng.randint(1, 3)
+    for x in range(0, width, period): draw.ellipse((x, period // 2 - radius, x + 2 * radius, period // 2 + radius), fill=rng.randint(40, 120))
+    return band
+
+def make_page(kind, width, height, seed):
+    from PIL import Image, ImageDraw
+    rng = random.Random(f"{kind}-{width}x{height}-{seed}")
+    if kind == "no_uniform": return Image.frombytes("L", (width, height), rng.randbytes(width * height)).convert("RGB")
+    page = Image.new("RGB", (width, height), (255, 255, 255)); draw = ImageDraw.Draw(page)
+    for top, bottom in _panel_rows(rng, height):
+        left = rng.randint(20, width // 4); right = width - rng.randint(20, width // 4)
+        if kind == "screentone":
+            tone = _screentone_band(rng, right - left)
+            for y in range(top, bottom, tone.height): page.paste(tone.convert("RGB"), (left, y), None)
+        else: draw.rectangle((left, top, right, bottom), fill=tuple(rng.randint(180, 250) for _ in range(3)))
+        draw.rectangle((left, top, right, bottom), outline=(0, 0, 0), width=4)
+        for _ in range(rng.randint(3, 12)):
+            x0 = rng.randint(left, right); y0 = rng.randint(top, bottom)
+            draw.line((x0, y0, rng.randint(left, right), rng.randint(top, bottom)), fill=(0, 0, 0), width=rng.randint(1, 5))
+    return page
+
+def make_watermark():
+    from PIL import Image, ImageDraw
+    watermark = Image.new("RGBA", (300, 120), (0, 0, 0, 0)); draw = ImageDraw.Draw(watermark)
+    draw.rounded_rectangle((0, 0, 299, 119), radius=30, fill=(20, 20, 20, 150)); draw.ellipse((20, 20, 100, 100), fill=(255, 255, 255, 220))
+    return watermark
+
+def page_sizes(scale): return {kind: (width, max(1000, int(height * scale))) for kind, (width, height) in PAGE_KINDS.items()}
+
+def prepare_sources(work_dir, scale, seed, magick_path):
+    # Writes every page kind as PNG and JPEG (and PSD when ImageMagick is available) plus a chapter batch for run_processing.
+    sources = {}; source_dir = os.path.join(work_dir, "sources"); os.makedirs(source_dir)
+    for kind, (width, height) in page_sizes(scale).items():
+        page = make_page(kind, width, height, seed); png_path = os.path.join(source_dir, kind + ".png"); jpg_path = os.path.join(source_dir, kind + ".jpg")
+        page.save(png_path, "PNG", compress_level=1); page.save(jpg_path, "JPEG", quality=90)
+        sources[kind] = {"image": page, "png": png_path, "jpg": jpg_path}
+        if magick_path:
+            psd_path = os.path.join(source_dir, kind + ".psd")
+            try: subprocess.run([magick_path, png_path, psd_path], check=True, capture_output=True); sources[kind]["psd"] = psd_path
+            except (OSError, subprocess.CalledProcessError) as e: print(f"Warning: could not create PSD for {kind}: {e}", file=sys.stderr)
+    batch_dir = os.path.join(work_dir, "batch")
+    for chapter_index in range(BATCH_CHAPTERS):
+        chapter_dir = os.path.join(batch_dir, f"chapter_{chapter_index + 1:02d}"); os.makedirs(chapter_dir)
+        for page_index in range(BATCH_PAGES_PER_CHAPTER):
+            kind = BATCH_PAGE_KINDS[page_index % len(BATCH_PAGE_KINDS)]
+            shutil.copy2(sources[kind]["png"], os.path.join(chapter_dir, f"{page_index + 1:03d}.png"))
+    watermark_path = os.path.join(work_dir, "watermark.png"); make_watermark().save(watermark_path)
+    return sources, batch_dir, watermark_path
+
+def measure(engine, repeat, action, setup=None):
+    times = []; peak_bytes = None
+    for _ in range(repeat):
+        state = setup() if setup else None
+        engine.reset_peak_memory(); start = time.perf_counter()
+        action(state); times.append(time.perf_counter() - start)
+        run_peak = engine.peak_memory_bytes()
+        if run_peak is not None: peak_bytes = max(peak_bytes or 0, run_peak)
+    return min(times), statistics.median(times), peak_bytes
+
+def bench_result(name, timing, pages, megabytes, **extra):
+    seconds, median_seconds, peak_bytes = timing
+    result = {"name": name, "seconds": round(seconds, 6), "median_seconds": round(median_seconds, 6), "pages": pages, "megabytes": round(megabytes, 3),
+              "pages_per_sec": round(pages / seconds, 3) if seconds else None, "mb_per_sec": round(megabytes / seconds, 3) if seconds else None,
+              "peak_rss_mb": round(peak_bytes / (1024 * 1024), 1) if peak_bytes is not None else None}
+    result.update(extra)
+    return result
+
+def decoded_megabytes(image): return image.size[0] * image.size[1] * 4 / (1024 * 1024)
+
+def bench_convert(engine, sources, work_dir, magick_path, repeat):
+    results = []; temp_dir = os.path.join(work_dir, "convert"); os.makedirs(temp_dir, exist_ok=True)
+    for kind, source in sources.items():
+        for source_format in ("png", "jpg", "psd"):
+            source_path = source.get(source_format)
+            if not source_path: continue
+            def convert(_state, source_path=source_path):
+                temp_png_path = engine.convert_to_temp_png(source_path, temp_dir, magick_path or engine.DEFAULT_IMAGEMAGICK_COMMAND, noop_status)
+                if not temp_png_path: raise RuntimeError(f"convert_to_temp_png failed for {source_path}")
+                os.remove(temp_png_path)
+            results.append(bench_result(f"convert_to_temp_png/{source_format}/{kind}", measure(engine, repeat, convert), 1, os.path.getsize(source_path) / (1024 * 1024)))
+    return results
+
+def bench_uniformity(engine, sources, watermark, config, repeat):
+    results = []; wm_w, wm_h = watermark.size
+    for kind, source in sources.items():
+        page = source["image"]; page_w, page_h = page.size; candidates = range(0, page_h - wm_h + 1, config['search_step'])
+        def check_all(_state):
+            for y in candidates: engine.check_area_uniformity(page, page_w - wm_w, y, wm_w, wm_h, config['threshold'])
+        results.append(bench_result(f"check_area_uniformity/{kind}", measure(engine, repeat, check_all), 1, decoded_megabytes(page), checks=len(candidates)))
+        # "variance-band" also searches one watermark width left of the edge; "placed" counts the spots found in the last run.
+        for search_name, search_config in [(search_engine, dict(config, search_engine=search_engine)) for search_engine in engine.SEARCH_ENGINES] + [("variance-band", dict(config, search_engine="variance", search_band=wm_w))]:
+            placements = []
+            def search_all(page_rgba):
+                uniformity_search = engine.create_uniformity_search(page_rgba, watermark, search_config); current_y_target = search_config['frequency']; placements.clear()
+                if page_h < search_config['frequency']: placements.append(uniformity_search.find_spot(range(0, page_h - wm_h + 1, engine.SHORT_IMAGE_SEARCH_STEP))); return
+                while current_y_target + wm_h <= page_h:
+                    placements.append(engine.search_and_place_watermark(page_rgba, watermark, search_config, current_y_target, current_y_target + search_config['frequency'], uniformity_search))
+                    current_y_target += search_config['frequency']
+            timing = measure(engine, repeat, search_all, lambda: page.convert("RGBA"))
+            results.append(bench_result(f"search_and_place_watermark/{search_name}/{kind}", timing, 1, decoded_megabytes(page), placed=sum(placement is not None for placement in placements), intervals=len(placements),
+                                        numpy=search_config['search_engine'] == "classic" or engine.get_numpy() is not None))
+    return results
+
+def bench_add_watermarks(engine, sources, watermark, config, repeat):
+    results = []
+    for kind, source in sources.items():
+        page = source["image"]
+        def add_watermarks(page_rgba):
+            if not engine.add_watermarks_to_image(page_rgba, watermark, io.BytesIO(), config, noop_status, output_format="PNG"): raise RuntimeError(f"add_watermarks_to_image failed for {kind}")
+        results.append(bench_result(f"add_watermarks_to_image/{kind}", measure(engine, repeat, add_watermarks, lambda: page.convert("RGBA")), 1, decoded_megabytes(page)))
+    return results
+
+def bench_run_processing(engine, batch_dir, watermark_path, config, repeat):
+    results = []; output_dir = batch_dir + engine.OUTPUT_SUFFIX
+    source_files = [os.path.join(root, filename) for root, _, filenames in os.walk(batch_dir) for filename in filenames]
+    source_megabytes = sum(os.path.getsize(path) for path in source_files) / (1024 * 1024)
+    for mode_name, create_zip in (("folder", False), ("zip", True)):
+        # The batch repeats the same few pages, so page and position reuse are off: every page is searched and watermarked, as the pages/sec figure assumes.
+        run_config = dict(config, create_zip=create_zip, incremental=False, dedup=False, placement_cache=False)
+        def clear_output(): shutil.rmtree(output_dir, ignore_errors=True)
+        def run_batch(_state):
+            summary = engine.run_processing(batch_dir, watermark_path, "png", engine.DEFAULT_IMAGEMAGICK_COMMAND, run_config, noop_status, stdout_to_stderr=True)
+            if not summary["ok"]: raise RuntimeError(f"run_processing reported errors: {summary}")
+        result = bench_result(f"run_processing/{mode_name}/workers_{config['workers']}", measure(engine, repeat, run_batch, clear_output), len(source_files), source_megabytes)
+        children_peak_bytes = children_peak_memory_bytes()
+        if config['workers'] > 1 and children_peak_bytes is not None: result["children_peak_rss_mb"] = round(children_peak_bytes / (1024 * 1024), 1)
+        results.append(result); clear_output()
+    return results
+
+def children_peak_memory_bytes():
+    try: import resource
+    except ImportError: return None
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+def compare_to_baseline(results, baseline, tolerance):
+    baseline_seconds = {result["name"]: result["seconds"] for result in baseline.get("results", [])}
+    changes = {}; regressions = []
+    for result in results:
+        previous_seconds = baseline_seconds.get(result["name"])
+        if not previous_seconds: continue
+        change = result["seconds"] / previous_seconds - 1; changes[result["name"]] = round(change, 4)
+        if change > tolerance: regressions.append(result["name"])
+    return {"changes": changes, "regressions": regressions, "tolerance": tolerance, "missing": sorted(set(baseline_seconds) - {result["name"] for result in results})}
+
+def print_comparison(results, baseline, comparison, stream):
+    baseline_seconds = {result["name"]: result["seconds"] for result in baseline.get("results", [])}
+    print(f"{'benchmark':60} {'baseline s':>11} {'current s':>11} {'change':>8}", file=stream)
+    for result in results:
+        if result["name"] not in comparison["changes"]: print(f"{result['name']:60} {'-':>11} {result['seconds']:>11.4f} {'new':>8}", file=stream); continue
+        flag = "  <-- slower" if result["name"] in comparison["regressions"] else ""
+        print(f"{result['name']:60} {baseline_seconds[result['name']]:>11.4f} {result['seconds']:>11.4f} {comparison['changes'][result['name']]:>+8.1%}{flag}", file=stream)
+    for name in comparison["missing"]: print(f"{name:60} missing from this run", file=stream)
+
+def run_benchmarks(engine, args, magick_path, config):
+    results = []; engine.get_numpy()
+    with tempfile.TemporaryDirectory(prefix="awm_bench_") as work_dir:
+        print("Generating synthetic pages...", file=sys.stderr)
+        sources, batch_dir, watermark_path = prepare_sources(work_dir, args.scale, args.seed, magick_path)
+        watermark = engine.PreparedWatermark.from_path(watermark_path)
+        benchmark_groups = {"convert": lambda: bench_convert(engine, sources, work_dir, magick_path, args.repeat),
+                            "search": lambda: bench_uniformity(engine, sources, watermark, config, args.repeat),
+                            "add_watermarks": lambda: bench_add_watermarks(engine, sources, watermark, config, args.repeat),
+                            "run_processing": lambda: bench_run_processing(engine, batch_dir, watermark_path, config, args.repeat)}
+        for group in BENCHMARK_GROUPS:
+            if args.only and group not in args.only: continue
+            print(f"Running {group}...", file=sys.stderr); results.extend(benchmark_groups[group]())
+    return results
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="watermarker_bench", description="Benchmark the watermarking pipeline on synthetic pages. Prints JSON results on stdout.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply page heights by this factor (e.g. 0.25 for a quick run).")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark; the fastest run is reported.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the synthetic pages.")
+    parser.add_argument("--workers", "-j", type=int, default=1, help="Workers for the run_processing benchmarks.")
+    parser.add_argument("--only", action="append", choices=BENCHMARK_GROUPS, help="Only run this benchmark group (repeatable).")
+    parser.add_argument("--magick-path", help="ImageMagick executable; enables the PSD conversion benchmarks.")
+    parser.add_argument("--output", "-o", metavar="FILE", help="Write the JSON results to FILE instead of stdout.")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare against a previous JSON result and exit with 1 on regressions.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed slowdown against the baseline (0.10 = 10%%).")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.scale <= 0 or args.repeat < 1 or args.workers < 1: print("--scale must be > 0, --repeat and --workers >= 1.", file=sys.stderr); return EXIT_INVALID_INPUT
+    baseline = None
+    if args.baseline:
+        try:
+            with open(args.baseline, 'r', encoding='utf-8') as baseline_file: baseline = json.load(baseline_file)
+        except (OSError, ValueError) as e: print(f"Could not read baseline '{args.baseline}': {e}", file=sys.stderr); return EXIT_INVALID_INPUT
+    import watermarker_engine as engine
+    from PIL import __version__ as pillow_version
+
+    magick_path = (shutil.which(args.magick_path) or args.magick_path) if args.magick_path else None
+    config = engine.build_run_config(dict(engine.DEFAULT_CONFIG, workers=str(args.workers)))
+    settings = {"scale": args.scale, "repeat": args.repeat, "seed": args.seed, "workers": args.workers, "psd": bool(magick_path), "config": {key: config[key] for key in ("frequency", "search_step", "threshold", "max_steps", "search_engine", "output_profile")}}
+    if baseline and baseline.get("settings") != settings: print("Warning: baseline was recorded with different settings; timings are not directly comparable.", file=sys.stderr)
+    results = []
+    # Engine diagnostics go to stdout; keep stdout for the JSON report only.
+    report_stream = sys.stdout; sys.stdout = sys.stderr
+    try:
+        results = run_benchmarks(engine, args, magick_path, config)
+    finally: sys.stdout = report_stream
+    report = {"version": BENCH_FORMAT_VERSION, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "pillow": pillow_version,
+              "numpy": engine.get_numpy().__version__ if engine.get_numpy() is not None else None, "platform": platform.platform(), "cpu_count": os.cpu_count(),
+              "settings": settings, "results": results}
+    exit_code = EXIT_OK
+    if baseline:
+        report["baseline"] = dict(compare_to_baseline(results, baseline, args.tolerance), file=args.baseline)
+        print_comparison(results, baseline, report["baseline"], sys.stderr)
+        if report["baseline"]["regressions"]: exit_code = EXIT_REGRESSION
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file: output_file.write(report_json + "\n")
+    else: print(report_json)
+    return exit_code
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
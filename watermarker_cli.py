@@ -0,0 +1,145 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import threading
+
+EXIT_OK = 0
+EXIT_FILE_ERRORS = 1
+EXIT_INVALID_INPUT = 2
+
+CLI_SETTING_ARGUMENTS = (
+    ("main_folder", ("--folder", "-f"), "Main folder with chapters or images."),
+    ("watermark_file", ("--watermark", "-w"), "Watermark image (PNG/JPEG)."),
+    ("frequency", ("--frequency",), "Interval between watermarks in px."),
+    ("search_step", ("--search-step",), "Step size for searching watermark placement in px."),
+    ("threshold", ("--threshold",), "Uniformity threshold."),
+    ("max_steps", ("--max-steps",), "Maximum search steps per interval."),
+    ("magick_path", ("--magick-path",), "Path to the ImageMagick executable (PSD/PSB only)."),
+    ("process_type", ("--process-type",), "File type to process: png (PNG/JPEG) or psd (PSD/PSB)."),
+    ("psd_reader", ("--psd-reader",), "PSD reader: auto (Pillow for .psd files it can decode, ImageMagick otherwise) or imagemagick."),
+    ("magick_transfer", ("--magick-transfer",), "How ImageMagick hands pixels over: png (temporary PNG files, batched) or raw (RGBA stream over a pipe)."),
+    ("output_profile", ("--output-profile",), "Output encoder profile: balanced, fast (low zlib level), smallest (optimized PNG), source (JPEG pages stay JPEG) or webp."),
+    ("output_quality", ("--quality",), "JPEG/WebP quality 1-100 for the source and webp profiles."),
+    ("memory_budget", ("--memory-budget",), "Process PNG output in bands to stay near this many MB per page (0 = whole page in memory)."),
+    ("workers", ("--workers", "-j"), "Number of worker processes."),
+    ("search_engine", ("--search-engine",), "Uniformity search engine: classic (default), sliding or variance (standard deviation, can also search left of the edge)."),
+    ("search_band", ("--search-band",), "With the variance engine, px left of the right edge that are searched as well (0 = right edge only)."),
+    ("zip_compression", ("--zip-compression",), "ZIP entry compression: auto (stored for PNG/JPEG/WebP), stored or deflate."),
+    ("zip_level", ("--zip-level",), "Deflate level 0-9 for deflated ZIP entries."),
+    ("watch_settle", ("--watch-settle",), "With --watch, seconds a chapter folder must stay unchanged before it is processed."),
+    ("prefetch_depth", ("--prefetch-depth",), "With one worker, pages read and decoded ahead of the page being watermarked (0 = no read-ahead)."),
+    ("write_depth", ("--write-depth",), "With one worker, watermarked pages waiting to be encoded and written behind it (0 = no write-behind)."),
+)
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="watermarker_cli", description="Headless Auto Watermarker. Prints a JSON summary on stdout and the processing log on stderr.")
+    for key, flags, help_text in CLI_SETTING_ARGUMENTS: parser.add_argument(*flags, dest=key, default=None, help=help_text)
+    zip_group = parser.add_mutually_exclusive_group()
+    zip_group.add_argument("--zip", dest="create_zip", action="store_true", default=None, help="Create a ZIP archive for each chapter.")
+    zip_group.add_argument("--no-zip", dest="create_zip", action="store_false", help="Write processed images to folders.")
+    incremental_group = parser.add_mutually_exclusive_group()
+    incremental_group.add_argument("--incremental", dest="incremental", action="store_true", default=None, help="Skip outputs whose source, watermark and settings are unchanged (default).")
+    incremental_group.add_argument("--no-incremental", dest="incremental", action="store_false", help="Reprocess every file.")
+    placement_group = parser.add_mutually_exclusive_group()
+    placement_group.add_argument("--placement-cache", dest="placement_cache", action="store_true", default=None, help="Reuse watermark positions found earlier for the same page, watermark size and search settings. Every page is hashed to find them.")
+    placement_group.add_argument("--no-placement-cache", dest="placement_cache", action="store_false", help="Search every page again (default).")
+    dedup_group = parser.add_mutually_exclusive_group()
+    dedup_group.add_argument("--dedup", dest="dedup", action="store_true", default=None, help="Watermark pages that occur several times in the run (same bytes) once and reuse the output (default).")
+    dedup_group.add_argument("--no-dedup", dest="dedup", action="store_false", help="Process every copy of a repeated page.")
+    parser.add_argument("--plan", dest="plan_only", action="store_true", default=None, help="Only find the watermark positions and export them to awm_plan.csv in the output folder; no images are written.")
+    parser.add_argument("--hash-sources", dest="hash_sources", action="store_true", default=None, help="Compare source files by content hash instead of size and modification time.")
+    parser.add_argument("--metrics", dest="metrics", action="store_true", default=None, help="Write per-file and per-stage timings to awm_metrics.json/.csv in the output folder.")
+    parser.add_argument("--profile", dest="profile", action="store_true", default=None, help="Profile the run with cProfile and write awm_profile.prof to the output folder.")
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument("--watch", action="store_true", help="Keep running and process chapter subfolders as they are added or changed. Stop with Ctrl+C; the summary covers the whole session.")
+    mode_group.add_argument("--job-worker", action="store_true", help="Claim and process jobs of a distributed run until all are done. Needs only --folder; the settings and watermark come from the jobs, --workers and --magick-path apply to this machine.")
+    mode_group.add_argument("--job-status", action="store_true", help="Print the merged progress and summary of all workers of a distributed run.")
+    parser.add_argument("--distribute", action="store_true", help="Split the run into one job per work folder under .awm_jobs in the output folder, for --job-worker processes on this or other machines sharing the folder. Combine with --job-worker to work as well.")
+    parser.add_argument("--lease", type=int, default=None, metavar="SECONDS", help="With --distribute, seconds after which a job whose worker stopped renewing its lease is handed to another worker.")
+    settings_group = parser.add_mutually_exclusive_group()
+    settings_group.add_argument("--settings", metavar="FILE", help="Load base settings from a JSON file in the GUI format.")
+    settings_group.add_argument("--use-saved-settings", action="store_true", help="Start from the settings saved by the GUI.")
+    parser.add_argument("--quiet", "-q", action="store_true", help="Do not print the processing log.")
+    return parser
+
+def resolve_settings(args, engine):
+    if args.use_saved_settings: settings = engine.load_saved_settings()
+    elif args.settings: settings = engine.load_saved_settings(args.settings)
+    else: settings = engine.DEFAULT_CONFIG.copy()
+    for key, _, _ in CLI_SETTING_ARGUMENTS:
+        value = getattr(args, key)
+        if value is not None: settings[key] = value
+    for key in ("create_zip", "incremental", "hash_sources", "placement_cache", "dedup", "plan_only", "metrics", "profile"):
+        if getattr(args, key) is not None: settings[key] = getattr(args, key)
+    return settings
+
+def resolve_magick_executable(settings, engine):
+    magick_path = settings.get("magick_path") or engine.DEFAULT_IMAGEMAGICK_COMMAND
+    magick_path = shutil.which(magick_path) or magick_path
+    is_valid, error_msg = engine.check_magick_executable(magick_path)
+    if not is_valid: raise ValueError(f"Processing PSD/PSB requires a working ImageMagick path: {error_msg}")
+    return magick_path
+
+def run_until_interrupted(run, status_callback):
+    # The first Ctrl+C lets the chapters in progress finish; a second one aborts.
+    stop_event = threading.Event()
+    def request_stop(signum, frame):
+        status_callback("Stopping after the current chapters... (Ctrl+C again to abort)"); stop_event.set(); signal.signal(signal.SIGINT, previous_handler)
+    previous_handler = signal.signal(signal.SIGINT, request_stop)
+    try: return run(stop_event)
+    finally: signal.signal(signal.SIGINT, previous_handler)
+
+def run_job_cli(args, engine, status_callback):
+    # Workers take the settings and watermark of the distributed run; only the folder, --workers and --magick-path are their own.
+    try:
+        settings = resolve_settings(args, engine); base_input_dir = settings.get("main_folder", "")
+        if not base_input_dir or not os.path.isdir(base_input_dir): raise ValueError("Please select the main folder.")
+        job_board = engine.JobBoard(base_input_dir.rstrip('/\\') + engine.OUTPUT_SUFFIX); job_settings = job_board.load_settings()
+        if args.job_status: summary = job_board.status(); return summary, EXIT_OK if not summary["errors"] and not summary["failed_jobs"] else EXIT_FILE_ERRORS
+        if args.workers is not None and (not engine.is_int(args.workers) or int(args.workers) < 1): raise ValueError("Workers must be a number >= 1.")
+        magick_executable = resolve_magick_executable(settings, engine) if job_settings["process_type"] == "psd" else engine.DEFAULT_IMAGEMAGICK_COMMAND
+    except ValueError as e: return {"ok": False, "fatal_error": str(e)}, EXIT_INVALID_INPUT
+    workers = int(args.workers) if args.workers is not None else None
+    summary = run_until_interrupted(lambda stop_event: engine.run_job_worker(base_input_dir, magick_executable, status_callback, stop_event, workers, stdout_to_stderr=True), status_callback)
+    if summary["fatal_error"]: return summary, EXIT_INVALID_INPUT
+    return summary, EXIT_OK if summary["ok"] else EXIT_FILE_ERRORS
+
+def run_cli(args, engine, status_callback):
+    if (args.job_worker and not args.distribute) or args.job_status: return run_job_cli(args, engine, status_callback)
+    try:
+        settings = resolve_settings(args, engine)
+        base_input_dir = settings.get("main_folder", ""); watermark_path = settings.get("watermark_file", ""); selected_process_type = settings.get("process_type", "png")
+        engine.validate_run_inputs(base_input_dir, watermark_path, selected_process_type)
+        config = engine.build_run_config(settings)
+        magick_executable = resolve_magick_executable(settings, engine) if selected_process_type == "psd" else engine.DEFAULT_IMAGEMAGICK_COMMAND
+    except ValueError as e: return {"ok": False, "fatal_error": str(e)}, EXIT_INVALID_INPUT
+    if args.distribute:
+        summary = engine.distribute_jobs(base_input_dir, watermark_path, selected_process_type, config, args.lease or engine.JOB_LEASE_SECONDS, status_callback)
+        if summary["fatal_error"]: return summary, EXIT_INVALID_INPUT
+        return run_job_cli(args, engine, status_callback) if args.job_worker else (summary, EXIT_OK)
+    if args.watch: summary = run_until_interrupted(lambda stop_event: engine.watch_folder(base_input_dir, watermark_path, selected_process_type, magick_executable, config, status_callback, stop_event=stop_event, stdout_to_stderr=True), status_callback)
+    else: summary = engine.run_processing(base_input_dir, watermark_path, selected_process_type, magick_executable, config, status_callback, stdout_to_stderr=True)
+    if summary["fatal_error"]: return summary, EXIT_INVALID_INPUT
+    return summary, EXIT_OK if summary["ok"] else EXIT_FILE_ERRORS
+
+def main(argv=None):
+    parser = build_parser(); args = parser.parse_args(argv)
+    if args.distribute and (args.watch or args.job_status): parser.error("--distribute cannot be combined with --watch or --job-status.")
+    if args.lease is not None and args.lease < 1: parser.error("--lease must be at least 1 second.")
+    import watermarker_engine as engine
+
+    status_callback = (lambda msg: None) if args.quiet else (lambda msg: print(msg, file=sys.stderr, flush=True))
+    # Engine diagnostics go to stdout; keep stdout for the JSON summary only.
+    summary_stream = sys.stdout; sys.stdout = sys.stderr
+    try: summary, exit_code = run_cli(args, engine, status_callback)
+    finally: sys.stdout = summary_stream
+    summary_stream.write(json.dumps(summary, ensure_ascii=False) + "\n"); summary_stream.flush()
+    return exit_code
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
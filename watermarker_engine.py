@@ -0,0 +1,1864 @@
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import os
+import io
+import sys
+import json
+import threading
+import queue
+import collections
+import shutil
+import signal
+import zipfile
+from PIL import Image, ImageStat, UnidentifiedImageError, features
+import traceback
+import tempfile
+import subprocess
+import time
+import hashlib
+import struct
+import zlib
+import contextlib
+import cProfile
+import pstats
+import csv
+import socket
+
+Image.MAX_IMAGE_PIXELS = None
+
+CONFIG_FILENAME = ".AutoWatermarkerConfig.json"
+OUTPUT_SUFFIX = "_Processed"
+SHORT_IMAGE_SEARCH_STEP = 1000
+EXTENSIONS_PSD_PSB = ('.psd', '.psb')
+EXTENSIONS_PNG_JPG = ('.png', '.jpg', '.jpeg')
+ALLOWED_WATERMARK_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+DEFAULT_CONFIG = {
+    "main_folder": "", "watermark_file": "", "frequency": "10000",
+    "search_step": "300", "threshold": "25", "max_steps": "10",
+    "create_zip": False, "magick_path": "", "process_type": "png",
+    "workers": "1", "search_engine": "classic",
+    "zip_compression": "auto", "zip_level": "6",
+    "incremental": True, "hash_sources": False, "psd_reader": "auto", "magick_transfer": "png",
+    "output_profile": "balanced", "output_quality": "90", "memory_budget": "0",
+    "metrics": False, "profile": False, "save_log": False, "watch_mode": False, "watch_settle": "10", "placement_cache": False, "plan_only": False,
+    "prefetch_depth": "2", "write_depth": "2", "search_band": "0", "dedup": True
+}
+PSD_READERS = ("auto", "imagemagick")
+MAGICK_TRANSFER_MODES = ("png", "raw")
+OUTPUT_PROFILES = ("balanced", "fast", "smallest", "source", "webp")
+PNG_ENCODER_OPTIONS = {"fast": {"compress_level": 1}, "balanced": {"compress_level": 6}, "smallest": {"optimize": True}}
+WEBP_MAX_DIMENSION = 16383
+OUTPUT_FORMATS_BY_EXTENSION = {".png": "PNG", ".jpg": "JPEG", ".jpeg": "JPEG", ".webp": "WEBP"}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_STREAM_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+PNG_STREAM_READ_SIZE = 1024 * 1024
+PNG_STREAM_COMPRESS_LEVELS = {"fast": 1, "balanced": 6, "smallest": 9}
+STRIP_BAND_COPIES = 6
+STRIP_MIN_BAND_ROWS = 16
+METRIC_STAGES = ("scan", "batch_convert", "convert", "decode", "search", "paste", "encode", "copy", "zip_write")
+METRICS_JSON_FILENAME = "awm_metrics.json"
+METRICS_CSV_FILENAME = "awm_metrics.csv"
+LOG_FILENAME = "awm_log.txt"
+PROFILE_FILENAME = "awm_profile.prof"
+MAGICK_BATCH_MAX_FILES = 100
+MANIFEST_FILENAME = ".awm_manifest.json"
+MANIFEST_VERSION = 1
+MANIFEST_SAVE_INTERVAL_SECONDS = 2.0
+PLACEMENT_CACHE_FILENAME = ".awm_placements.json"
+PLACEMENT_CACHE_VERSION = 2
+PLACEMENT_KEY_CONFIG_KEYS = ("frequency", "search_step", "threshold", "max_steps")
+PLAN_FILENAME = "awm_plan.csv"
+PARTIAL_SUFFIX = ".part"
+JOBS_DIRNAME = ".awm_jobs"
+JOB_SETTINGS_FILENAME = "settings.json"
+JOB_LEASE_SECONDS = 120
+JOB_POLL_SECONDS = 5.0
+WATCH_POLL_INTERVAL_SECONDS = 2.0
+WATCH_RESCAN_INTERVAL_SECONDS = 60.0
+WATCH_IGNORED_EVENTS = ("opened", "closed_no_write")
+OUTPUT_CONFIG_KEYS = ("frequency", "search_step", "threshold", "max_steps", "create_zip", "zip_compression", "zip_level", "output_profile", "output_quality")
+PSD_OUTPUT_CONFIG_KEYS = ("psd_reader", "magick_transfer")
+SEARCH_ENGINES = ("classic", "sliding", "variance")
+ZIP_COMPRESSION_MODES = ("auto", "stored", "deflate")
+ALREADY_COMPRESSED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+PARALLEL_FOLDER_LIMIT = 4
+PIPELINE_POLL_SECONDS = 0.1
+DEFAULT_IMAGEMAGICK_COMMAND = "magick"
+CONFIG_NUMBER_CHECKS = (("frequency", "Frequency", 1), ("search_step", "Search step", 1), ("threshold", "Uniformity thresh.", 0), ("max_steps", "Max steps", 0), ("workers", "Workers", 1), ("zip_level", "ZIP level", 0), ("output_quality", "Quality", 1), ("memory_budget", "Memory budget (MB)", 0), ("watch_settle", "Watch settle time (s)", 1), ("prefetch_depth", "Read-ahead pages", 0), ("write_depth", "Write-behind pages", 0), ("search_band", "Search band (px)", 0))
+
+np = None; _numpy_checked = False
+_watchdog_modules = None; _watchdog_checked = False
+_metrics_state = threading.local(); _NO_STAGE = contextlib.nullcontext()
+
+def get_numpy():
+    # numpy is optional and slow to import, so it is only loaded once a search actually needs it.
+    global np, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try: import numpy as numpy_module; np = numpy_module
+        except ImportError: np = None
+    return np
+
+def get_watchdog():
+    # watchdog is optional; it delivers native file events (inotify on Linux). Without it the watch mode polls the folder.
+    global _watchdog_modules, _watchdog_checked
+    if not _watchdog_checked:
+        _watchdog_checked = True
+        try: from watchdog.observers import Observer; from watchdog.events import FileSystemEventHandler; _watchdog_modules = (Observer, FileSystemEventHandler)
+        except ImportError: _watchdog_modules = None
+    return _watchdog_modules
+
+def is_int(value):
+    try: int(value); return True
+    except ValueError: return False
+
+class StageMetrics:
+    def __init__(self): self.stages = {}; self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try: yield
+        finally: self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, value): self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        _add_stages(self.stages, other.stages); self.total = getattr(self, "total", 0.0) + other.total
+        for name, value in other.counters.items(): self.count(name, value)
+
+    def as_dict(self): return {"stages": {name: round(seconds, 6) for name, seconds in self.stages.items()}, **self.counters}
+
+def metrics_stage(name):
+    # Stage timers only run while a file is being measured on this thread; otherwise this returns a shared no-op context.
+    stage_metrics = getattr(_metrics_state, "current", None)
+    return stage_metrics.stage(name) if stage_metrics is not None else _NO_STAGE
+
+def metrics_count(name, value):
+    stage_metrics = getattr(_metrics_state, "current", None)
+    if stage_metrics is not None: stage_metrics.count(name, value)
+
+@contextlib.contextmanager
+def measuring_stages():
+    stage_metrics = StageMetrics(); previous_metrics = getattr(_metrics_state, "current", None); _metrics_state.current = stage_metrics; start = time.perf_counter()
+    try: yield stage_metrics
+    finally: _metrics_state.current = previous_metrics; stage_metrics.total = time.perf_counter() - start
+
+def _add_stages(total_stages, stages):
+    for name, seconds in stages.items(): total_stages[name] = total_stages.get(name, 0.0) + seconds
+
+class RunMetrics:
+    # Collects per-file and per-folder stage timings from worker results and folder threads, and writes the run report.
+    def __init__(self):
+        self.lock = threading.Lock(); self.files = []; self.folders = []; self.run_stages = StageMetrics(); self.start = time.perf_counter()
+
+    def stage(self, name): return self.run_stages.stage(name)
+
+    def add_file(self, folder_index, folder_name, filename, success, file_metrics):
+        record = {"folder": folder_name, "file": filename, "success": success, "seconds": None, "candidates": 0, "stages": {}}
+        if file_metrics: record.update(file_metrics)
+        with self.lock: self.files.append((folder_index, len(self.files), record))
+
+    def add_folder(self, folder_index, folder_name, processed_counts, folder_metrics):
+        record = {"folder": folder_name, "success": processed_counts[0], "errors": processed_counts[1], "skipped": processed_counts[2], "seconds": round(folder_metrics.total, 6), "stages": dict(folder_metrics.stages)}
+        with self.lock: self.folders.append((folder_index, record))
+
+    def build_report(self, summary):
+        files = sorted(self.files, key=lambda item: item[:2]); folders = sorted(self.folders, key=lambda item: item[0]); run_stages = dict(self.run_stages.stages)
+        for folder_index, folder_record in folders:
+            folder_files = [record for file_folder_index, _, record in files if file_folder_index == folder_index]
+            for record in folder_files: _add_stages(folder_record["stages"], record["stages"])
+            folder_record["files"] = len(folder_files); folder_record["candidates"] = sum(record["candidates"] for record in folder_files)
+            _add_stages(run_stages, folder_record["stages"]); folder_record["stages"] = {name: round(seconds, 6) for name, seconds in folder_record["stages"].items()}
+        return {"summary": summary, "seconds": round(time.perf_counter() - self.start, 6), "candidates": sum(record["candidates"] for _, _, record in files),
+                "stages": {name: round(seconds, 6) for name, seconds in run_stages.items()}, "folders": [record for _, record in folders], "files": [record for _, _, record in files]}
+
+    def write_reports(self, main_output_dir, summary):
+        report = self.build_report(summary)
+        json_path = os.path.join(main_output_dir, METRICS_JSON_FILENAME); csv_path = os.path.join(main_output_dir, METRICS_CSV_FILENAME)
+        with open(json_path, 'w', encoding='utf-8') as json_file: json.dump(report, json_file, indent=2, ensure_ascii=False)
+        with open(csv_path, 'w', encoding='utf-8', newline='') as csv_file:
+            csv_writer = csv.writer(csv_file); csv_writer.writerow(["folder", "file", "success", "seconds", "candidates"] + list(METRIC_STAGES))
+            for record in report["files"]: csv_writer.writerow([record["folder"], record["file"], record["success"], record["seconds"], record["candidates"]] + [record["stages"].get(name, "") for name in METRIC_STAGES])
+        return report, json_path, csv_path
+
+def format_stage_totals(stages):
+    return ", ".join(f"{name} {stages[name]:.2f}s" for name in METRIC_STAGES if stages.get(name))
+
+def get_config_path():
+    home_dir = os.path.expanduser("~")
+    preferred_dir = os.path.join(home_dir, ".config", "AutoWatermarker")
+    fallback_dir = os.path.join(home_dir, "AutoWatermarker")
+    final_dir = None
+    try: os.makedirs(preferred_dir, exist_ok=True); final_dir = preferred_dir
+    except OSError:
+        print(f"Warning: Could not create config directory '{preferred_dir}'. Trying fallback.")
+        try: os.makedirs(fallback_dir, exist_ok=True); final_dir = fallback_dir; print(f"Using fallback config directory: {final_dir}")
+        except OSError as e: print(f"ERROR: Could not create any config directory. Saving in home directory. Error: {e}"); final_dir = home_dir
+    return os.path.join(final_dir, CONFIG_FILENAME)
+
+def load_saved_settings(config_path=None):
+    config_path = config_path or get_config_path(); settings = DEFAULT_CONFIG.copy()
+    try:
+        if os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                loaded_settings = json.load(f)
+                for key, default_value in DEFAULT_CONFIG.items(): settings[key] = loaded_settings.get(key, default_value)
+            print(f"Settings loaded from {config_path}")
+        else: print("Settings file not found.")
+    except Exception as e: print(f"Error loading settings from '{config_path}': {e}."); settings = DEFAULT_CONFIG.copy()
+    return settings
+
+def save_settings_file(settings, config_path=None):
+    config_path = config_path or get_config_path()
+    try:
+        os.makedirs(os.path.dirname(config_path), exist_ok=True)
+        with open(config_path, 'w', encoding='utf-8') as f: json.dump(settings, f, indent=4, ensure_ascii=False)
+        print(f"Settings saved to {config_path}")
+    except Exception as e: print(f"Error saving settings to '{config_path}': {e}")
+
+def build_run_config(settings):
+    config = {}
+    for key, name, min_val in CONFIG_NUMBER_CHECKS:
+        val_str = str(settings.get(key, DEFAULT_CONFIG[key]))
+        if not is_int(val_str) or int(val_str) < min_val: raise ValueError(f"{name} must be a number >= {min_val}.")
+        config[key] = int(val_str)
+    search_engine = settings.get("search_engine", DEFAULT_CONFIG["search_engine"])
+    if search_engine not in SEARCH_ENGINES: raise ValueError(f"Search engine must be one of: {', '.join(SEARCH_ENGINES)}.")
+    config['search_engine'] = search_engine; config['create_zip'] = bool(settings.get("create_zip", DEFAULT_CONFIG["create_zip"]))
+    zip_compression = settings.get("zip_compression", DEFAULT_CONFIG["zip_compression"])
+    if zip_compression not in ZIP_COMPRESSION_MODES: raise ValueError(f"ZIP compression must be one of: {', '.join(ZIP_COMPRESSION_MODES)}.")
+    if config['zip_level'] > 9: raise ValueError("ZIP level must be a number between 0 and 9.")
+    config['zip_compression'] = zip_compression
+    psd_reader = settings.get("psd_reader", DEFAULT_CONFIG["psd_reader"])
+    if psd_reader not in PSD_READERS: raise ValueError(f"PSD reader must be one of: {', '.join(PSD_READERS)}.")
+    config['psd_reader'] = psd_reader
+    magick_transfer = settings.get("magick_transfer", DEFAULT_CONFIG["magick_transfer"])
+    if magick_transfer not in MAGICK_TRANSFER_MODES: raise ValueError(f"ImageMagick transfer must be one of: {', '.join(MAGICK_TRANSFER_MODES)}.")
+    config['magick_transfer'] = magick_transfer
+    output_profile = settings.get("output_profile", DEFAULT_CONFIG["output_profile"])
+    if output_profile not in OUTPUT_PROFILES: raise ValueError(f"Output profile must be one of: {', '.join(OUTPUT_PROFILES)}.")
+    if output_profile == "webp" and not features.check("webp"): raise ValueError("This Pillow build cannot write WebP files.")
+    if config['output_quality'] > 100: raise ValueError("Quality must be a number between 1 and 100.")
+    config['output_profile'] = output_profile
+    config['incremental'] = bool(settings.get("incremental", DEFAULT_CONFIG["incremental"])); config['hash_sources'] = bool(settings.get("hash_sources", DEFAULT_CONFIG["hash_sources"]))
+    config['metrics'] = bool(settings.get("metrics", DEFAULT_CONFIG["metrics"])); config['profile'] = bool(settings.get("profile", DEFAULT_CONFIG["profile"])); config['save_log'] = bool(settings.get("save_log", DEFAULT_CONFIG["save_log"]))
+    config['placement_cache'] = bool(settings.get("placement_cache", DEFAULT_CONFIG["placement_cache"])); config['plan_only'] = bool(settings.get("plan_only", DEFAULT_CONFIG["plan_only"]))
+    config['dedup'] = bool(settings.get("dedup", DEFAULT_CONFIG["dedup"]))
+    return config
+
+def validate_run_inputs(base_input_dir, watermark_path, selected_process_type):
+    if not base_input_dir or not os.path.isdir(base_input_dir): raise ValueError("Please select the main folder.")
+    if not watermark_path or not os.path.isfile(watermark_path): raise ValueError("Please select the watermark file.")
+    wm_ext = os.path.splitext(watermark_path)[1].lower()
+    if wm_ext not in ALLOWED_WATERMARK_EXTENSIONS: raise ValueError(f"Watermark format ({wm_ext}) is not supported.")
+    if selected_process_type not in ("png", "psd"): raise ValueError(f"File type ({selected_process_type}) is not supported.")
+
+def check_magick_executable(path_to_check):
+    if not path_to_check or not os.path.isfile(path_to_check): return False, "File not found or path not specified."
+    command = [path_to_check, "-version"]
+    try:
+        result = subprocess.run(command, check=True, capture_output=True, text=True, encoding='utf-8', errors='replace', startupinfo=None, timeout=10)
+        print(f"ImageMagick version check successful:\n{result.stdout[:200]}...")
+        return True, None
+    except FileNotFoundError: return False, f"File '{os.path.basename(path_to_check)}' not found."
+    except subprocess.CalledProcessError as e: error_message = f"ImageMagick command returned an error (code {e.returncode})."; print(f"--- IMAGEMAGICK Version Check Error ---\nCommand: {' '.join(e.cmd)}\nStderr:\n{e.stderr}\n--- END ERROR ---"); return False, error_message
+    except subprocess.TimeoutExpired: return False, "ImageMagick check timed out."
+    except Exception as e: error_message = f"Unexpected error checking ImageMagick: {type(e).__name__}"; print(f"--- UNEXPECTED Check Error ---\n{traceback.format_exc()}\n--- END ERROR ---"); return False, error_message
+
+def convert_to_temp_png(original_path, temp_dir, magick_executable_path, status_callback):
+    original_filename = os.path.basename(original_path)
+    base_name = os.path.splitext(original_filename)[0]
+    temp_png_filename = base_name + "_temp.png"
+    temp_png_path = os.path.join(temp_dir, temp_png_filename)
+    original_format = os.path.splitext(original_filename)[1].lower()
+    conversion_success = False
+
+    status_callback(f"  Converting/copying: {original_filename} -> PNG...")
+
+    try:
+        if original_format == ".png":
+            shutil.copy2(original_path, temp_png_path)
+            conversion_success = True
+        elif original_format in ('.psd', '.psb'):
+            status_callback(f"   (Using ImageMagick: {magick_executable_path})")
+            input_spec = f"{original_path}[0]"
+            command_list = [magick_executable_path, input_spec, temp_png_path]
+            try:
+                run_result = subprocess.run(command_list, check=True, capture_output=True, text=True, encoding='utf-8', errors='replace', startupinfo=None)
+                conversion_success = True
+            except FileNotFoundError:
+                 status_callback(f"  ! ERROR: ImageMagick path '{magick_executable_path}' not found.")
+                 conversion_success = False
+            except subprocess.CalledProcessError as process_error:
+                 status_callback(f"  ! ImageMagick error converting {original_filename}")
+                 print(f"--- IMAGEMAGICK ERROR for {original_path} ---\nCommand: {' '.join(process_error.cmd)}\nReturn Code: {process_error.returncode}\nStderr:\n{process_error.stderr}\nStdout:\n{process_error.stdout}\n--- END IMAGEMAGICK ERROR ---")
+                 conversion_success = False
+            except Exception as subprocess_error:
+                 status_callback(f"  ! Unexpected subprocess error: {type(subprocess_error).__name__}")
+                 print(f"--- SUBPROCESS ERROR for {original_path} ---\n{traceback.format_exc()}\n--- END SUBPROCESS ERROR ---")
+                 conversion_success = False
+        elif original_format in ('.jpg', '.jpeg'):
+            with Image.open(original_path) as img, img.convert("RGBA") as rgba_img:
+                rgba_img.save(temp_png_path, "PNG")
+            conversion_success = True
+        else:
+             status_callback(f"  ! Unsupported format: {original_filename}")
+
+        if conversion_success and os.path.exists(temp_png_path) and os.path.getsize(temp_png_path) > 0:
+            return temp_png_path
+        else:
+            if conversion_success: status_callback(f"  ! Error: Conversion of {original_filename} created an empty file.")
+            if os.path.exists(temp_png_path):
+                 try: os.remove(temp_png_path)
+                 except OSError as remove_error: print(f"Warning: Could not remove temp file: {temp_png_path}. Error: {remove_error}")
+            return None
+
+    except Exception as top_level_error:
+        status_callback(f"  ! Critical error during conversion stage for {original_filename}: {type(top_level_error).__name__}")
+        print(f"--- TOP LEVEL CONVERSION STAGE ERROR for {original_path} ---\n{traceback.format_exc()}\n--- END ERROR ---")
+        if 'temp_png_path' in locals() and os.path.exists(temp_png_path):
+             try: os.remove(temp_png_path)
+             except OSError: pass
+        return None
+
+def batch_convert_to_temp_png(original_paths, temp_dir, magick_executable_path, status_callback, parallel_invocations=1):
+    # Flattens many PSD/PSB files with a few "magick mogrify" runs instead of one process per file.
+    # Files missing from the result are left to convert_to_temp_png, which reports errors per file.
+    stem_counts = {}
+    for original_path in original_paths:
+        stem = os.path.splitext(os.path.basename(original_path))[0].lower(); stem_counts[stem] = stem_counts.get(stem, 0) + 1
+    batch_paths = [p for p in original_paths if stem_counts[os.path.splitext(os.path.basename(p))[0].lower()] == 1]
+    if not batch_paths: return {}
+    chunk_count = max(min(parallel_invocations, len(batch_paths)), -(-len(batch_paths) // MAGICK_BATCH_MAX_FILES))
+    chunks = [batch_paths[i::chunk_count] for i in range(chunk_count)]
+    status_callback(f"  Batch converting {len(batch_paths)} files with ImageMagick ({chunk_count} process{'es' if chunk_count > 1 else ''})...")
+
+    def run_chunk(chunk):
+        command_list = [magick_executable_path, "mogrify", "-path", temp_dir, "-format", "png"] + [f"{original_path}[0]" for original_path in chunk]
+        try: subprocess.run(command_list, check=True, capture_output=True, text=True, encoding='utf-8', errors='replace', startupinfo=None)
+        except FileNotFoundError: status_callback(f"  ! ERROR: ImageMagick path '{magick_executable_path}' not found.")
+        except subprocess.CalledProcessError as process_error:
+            print(f"--- IMAGEMAGICK BATCH ERROR ({len(chunk)} files) ---\nReturn Code: {process_error.returncode}\nStderr:\n{process_error.stderr}\n--- END IMAGEMAGICK ERROR ---")
+        except Exception:
+            print(f"--- BATCH SUBPROCESS ERROR ---\n{traceback.format_exc()}\n--- END SUBPROCESS ERROR ---")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(parallel_invocations, chunk_count)) as magick_executor: list(magick_executor.map(run_chunk, chunks))
+    converted_paths = {}
+    for original_path in batch_paths:
+        temp_png_path = os.path.join(temp_dir, os.path.splitext(os.path.basename(original_path))[0] + ".png")
+        if os.path.isfile(temp_png_path) and os.path.getsize(temp_png_path) > 0: converted_paths[original_path] = temp_png_path
+    return converted_paths
+
+def load_via_magick_raw(original_path, magick_executable_path, status_callback):
+    # Streams the flattened first layer as raw 8-bit RGBA over stdout, skipping the PNG encode/decode round trip.
+    # Returns None on any problem so the caller can fall back to the PNG route.
+    original_filename = os.path.basename(original_path); input_spec = f"{original_path}[0]"
+    status_callback(f"  Streaming raw pixels: {original_filename} (ImageMagick)...")
+    try:
+        identify_result = subprocess.run([magick_executable_path, "identify", "-ping", "-format", "%w %h", input_spec], check=True, capture_output=True, text=True, encoding='utf-8', errors='replace', startupinfo=None)
+        width, height = (int(value) for value in identify_result.stdout.split()[:2])
+        pixel_result = subprocess.run([magick_executable_path, input_spec, "-colorspace", "sRGB", "-depth", "8", "RGBA:-"], check=True, capture_output=True, startupinfo=None)
+    except FileNotFoundError: status_callback(f"  ! ERROR: ImageMagick path '{magick_executable_path}' not found."); return None
+    except subprocess.CalledProcessError as process_error:
+        print(f"--- IMAGEMAGICK RAW ERROR for {original_path} ---\nCommand: {' '.join(process_error.cmd)}\nReturn Code: {process_error.returncode}\nStderr:\n{process_error.stderr}\n--- END IMAGEMAGICK ERROR ---"); return None
+    except ValueError: status_callback(f"  - Could not read the size of {original_filename}, using PNG conversion."); return None
+    expected_length = width * height * 4
+    if width <= 0 or height <= 0 or len(pixel_result.stdout) != expected_length:
+        status_callback(f"  - Raw pixel data of {original_filename} has {len(pixel_result.stdout)} bytes, expected {expected_length}; using PNG conversion."); return None
+    return Image.frombuffer("RGBA", (width, height), pixel_result.stdout, "raw", "RGBA", 0, 1)
+
+def pillow_can_read_psd(original_path):
+    try:
+        with Image.open(original_path) as img: return img.format == "PSD"
+    except Exception: return False
+
+def open_image_rgba(image_path):
+    with metrics_stage("decode"):
+        img = Image.open(image_path); img.load()
+        return img if img.mode == "RGBA" else img.convert("RGBA")
+
+class PreparedWatermark:
+    def __init__(self, image):
+        self.image = image if image.mode == "RGBA" else image.convert("RGBA")
+        self.mask = self.image.getchannel("A"); self.size = self.image.size; self.width, self.height = self.size
+
+    @classmethod
+    def from_path(cls, watermark_path): return cls(open_image_rgba(watermark_path))
+
+    def fits(self, main_w, main_h): return self.width <= main_w and self.height <= main_h
+
+    def paste_onto(self, main_img, position):
+        with metrics_stage("paste"): main_img.paste(self.image, position, self.mask)
+
+    def __getstate__(self): return {"size": self.size, "data": self.image.tobytes()}
+
+    def __setstate__(self, state): self.__init__(Image.frombytes("RGBA", state["size"], state["data"]))
+
+_worker_watermark = None; _worker_profiler = None
+
+def _init_worker(prepared_watermark, stdout_to_stderr=False):
+    global _worker_watermark
+    _worker_watermark = prepared_watermark
+    if stdout_to_stderr: sys.stdout = sys.stderr
+    # Ctrl+C is handled by the main process, which lets running pages finish (a watch session stops after the current chapters).
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def load_page_image(original_path, temp_dir, magick_executable_path, status_callback, preconverted_png_path=None, psd_reader="imagemagick", magick_transfer="png"):
+    original_filename = os.path.basename(original_path)
+    original_format = os.path.splitext(original_filename)[1].lower()
+    try:
+        if original_format in EXTENSIONS_PNG_JPG:
+            status_callback(f"  Loading: {original_filename}...")
+            return open_image_rgba(original_path)
+        elif original_format in EXTENSIONS_PSD_PSB:
+            if psd_reader == "auto" and not preconverted_png_path and original_format == ".psd":
+                try:
+                    status_callback(f"  Loading with Pillow: {original_filename}..."); return open_image_rgba(original_path)
+                except Exception as pillow_error: status_callback(f"  - Pillow could not read {original_filename} ({type(pillow_error).__name__}), using ImageMagick.")
+            if magick_transfer == "raw" and not preconverted_png_path:
+                with metrics_stage("convert"): raw_img = load_via_magick_raw(original_path, magick_executable_path, status_callback)
+                if raw_img is not None: return raw_img
+            if preconverted_png_path and os.path.isfile(preconverted_png_path): status_callback(f"  Loading batch-converted: {original_filename}..."); temp_png_path = preconverted_png_path
+            else:
+                with metrics_stage("convert"): temp_png_path = convert_to_temp_png(original_path, temp_dir, magick_executable_path, status_callback)
+            if not temp_png_path: return None
+            try: return open_image_rgba(temp_png_path)
+            finally:
+                try: os.remove(temp_png_path)
+                except OSError as remove_error: print(f"Warning: Could not remove temp file: {temp_png_path}. Error: {remove_error}")
+        else:
+            status_callback(f"  ! Unsupported format: {original_filename}"); return None
+    except FileNotFoundError: status_callback(f"  ! Error: '{original_filename}' not found."); return None
+    except UnidentifiedImageError: status_callback(f"  ! Error: Could not identify image format '{original_filename}'."); return None
+    except Exception as e:
+        status_callback(f"  ! Error loading '{original_filename}': {type(e).__name__}")
+        print(f"--- LOADING ERROR for {original_path} ---\n{traceback.format_exc()}\n--- END ERROR ---"); return None
+
+def output_filename_for(filename, config):
+    # "source" keeps JPEG pages as JPEG, "webp" writes every page as WebP; everything else becomes PNG.
+    base_name, extension = os.path.splitext(filename); output_profile = config.get('output_profile', "balanced")
+    if output_profile == "webp": return base_name + ".webp"
+    if output_profile == "source" and extension.lower() in ('.jpg', '.jpeg'): return base_name + extension
+    return base_name + ".png"
+
+def output_format_for(filename): return OUTPUT_FORMATS_BY_EXTENSION.get(os.path.splitext(filename)[1].lower(), "PNG")
+
+def save_output_image(img, output_target, output_format, config):
+    with metrics_stage("encode"): _save_output_image(img, output_target, output_format, config)
+
+def _save_output_image(img, output_target, output_format, config):
+    quality = config.get('output_quality', 90)
+    if output_format == "JPEG":
+        with img.convert("RGB") as rgb_img: rgb_img.save(output_target, "JPEG", quality=quality, optimize=config.get('output_profile') == "smallest")
+    elif output_format == "WEBP":
+        if max(img.size) > WEBP_MAX_DIMENSION: raise ValueError(f"page is {img.size[0]}x{img.size[1]} px, WebP allows at most {WEBP_MAX_DIMENSION} px per side")
+        img.save(output_target, "WEBP", quality=quality, method=6 if config.get('output_profile') == "smallest" else 4)
+    else: img.save(output_target, "PNG", **PNG_ENCODER_OPTIONS.get(config.get('output_profile'), PNG_ENCODER_OPTIONS["balanced"]))
+
+def _process_page_in_bands(original_file_path, temp_dir, magick_executable_path, watermark, output_target, config, status_callback, preconverted_png_path=None, placement_plan=None):
+    original_filename = os.path.basename(original_file_path)
+    if original_file_path.lower().endswith(".png"): status_callback(f"  Loading: {original_filename}..."); png_path = original_file_path
+    elif preconverted_png_path and os.path.isfile(preconverted_png_path): status_callback(f"  Loading batch-converted: {original_filename}..."); png_path = preconverted_png_path
+    else:
+        with metrics_stage("convert"): png_path = convert_to_temp_png(original_file_path, temp_dir, magick_executable_path, status_callback)
+    if not png_path: return False
+    try:
+        try: reader = PngBandReader.open(png_path)
+        except (OSError, ValueError) as e: status_callback(f"  ! Error reading '{original_filename}': {e}"); return False
+        if reader is not None: return add_watermarks_to_png_bands(reader, watermark, output_target, config, status_callback, source_copy_path=original_file_path, placement_plan=placement_plan)
+        status_callback(f"  - {original_filename} is not an 8-bit non-interlaced PNG, loading the whole page.")
+        main_img = load_page_image(png_path, temp_dir, magick_executable_path, status_callback)
+        if main_img is None: return False
+        try: return add_watermarks_to_image(main_img, watermark, output_target, config, status_callback, source_copy_path=original_file_path, output_format="PNG", placement_plan=placement_plan)
+        finally: main_img.close()
+    finally:
+        if png_path != original_file_path:
+            try: os.remove(png_path)
+            except OSError as remove_error: print(f"Warning: Could not remove temp file: {png_path}. Error: {remove_error}")
+
+def _process_page(original_file_path, temp_dir, magick_executable_path, watermark, output_filename, output_dir, is_zip_mode, config, status_callback, preconverted_png_path=None, placement_plan=None):
+    # In ZIP mode the encoded page is returned as bytes for the archive writer; otherwise it is written to output_dir.
+    # Folder outputs are written under a .part name and renamed when complete, so the output folder never holds half-written pages.
+    # A plan-only run stops after the search and writes nothing.
+    output_final_path, output_target = _output_target_for(output_filename, output_dir, is_zip_mode, config); output_format = output_format_for(output_filename)
+    if config.get('memory_budget') and output_format == "PNG" and original_file_path.lower().endswith((".png",) + EXTENSIONS_PSD_PSB):
+        watermark_step_success = _process_page_in_bands(original_file_path, temp_dir, magick_executable_path, watermark, output_target, config, status_callback, preconverted_png_path, placement_plan)
+    else:
+        main_img = load_page_image(original_file_path, temp_dir, magick_executable_path, status_callback, preconverted_png_path, config.get('psd_reader', "imagemagick"), config.get('magick_transfer', "png"))
+        if main_img is None: return False, None
+        try: watermark_step_success = add_watermarks_to_image(main_img, watermark, output_target, config, status_callback, source_copy_path=original_file_path, output_format=output_format, placement_plan=placement_plan)
+        finally: main_img.close()
+    return _finish_output(output_target, output_final_path, watermark_step_success, status_callback)
+
+def _output_target_for(output_filename, output_dir, is_zip_mode, config):
+    output_final_path = None if is_zip_mode else os.path.join(output_dir, output_filename)
+    return output_final_path, None if config.get('plan_only') else io.BytesIO() if is_zip_mode else partial_output_path(output_final_path, config)
+
+def partial_output_path(path, config):
+    # Job workers can take over each other's chapters while the old worker is still finishing a page, so theirs carry the node name.
+    return node_temp_path(path, PARTIAL_SUFFIX) if config.get('node_partials') else path + PARTIAL_SUFFIX
+
+def _finish_output(output_target, output_final_path, success, status_callback):
+    if output_target is None: return success, None
+    if output_final_path is None: return success, output_target.getvalue() if success else None
+    return publish_partial_output(output_target, output_final_path, success, status_callback), output_final_path
+
+def publish_partial_output(partial_path, final_path, success, status_callback):
+    try:
+        if success:
+            if os.path.isdir(partial_path) and os.path.isdir(final_path):
+                # A nested chapter can be published into a folder that already holds its sibling chapters.
+                for entry_name in os.listdir(partial_path): os.replace(os.path.join(partial_path, entry_name), os.path.join(final_path, entry_name))
+                os.rmdir(partial_path)
+            else: os.replace(partial_path, final_path)
+            return True
+        if os.path.isdir(partial_path): shutil.rmtree(partial_path)
+        elif os.path.exists(partial_path): os.remove(partial_path)
+    except OSError as e: status_callback(f"  ! Could not publish '{os.path.basename(final_path)}': {e}")
+    return False
+
+def process_single_file(original_file_path, temp_dir, magick_executable_path, watermark, output_filename, output_dir, is_zip_mode, config, status_callback, preconverted_png_path=None, placement_plan=None):
+    if not config.get('memory_budget'): return _process_page(original_file_path, temp_dir, magick_executable_path, watermark, output_filename, output_dir, is_zip_mode, config, status_callback, preconverted_png_path, placement_plan)
+    peak_is_per_file = reset_peak_memory()
+    try: return _process_page(original_file_path, temp_dir, magick_executable_path, watermark, output_filename, output_dir, is_zip_mode, config, status_callback, preconverted_png_path, placement_plan)
+    finally:
+        peak_bytes = peak_memory_bytes()
+        if peak_bytes is not None: status_callback(f"  Peak memory: {peak_bytes / (1024 * 1024):.0f} MB" + ("" if peak_is_per_file else " (whole process)"))
+
+def zip_compression_for(arcname, config):
+    zip_compression = config.get('zip_compression', "auto")
+    if zip_compression == "auto": zip_compression = "stored" if arcname.lower().endswith(ALREADY_COMPRESSED_EXTENSIONS) else "deflate"
+    return (zipfile.ZIP_STORED, None) if zip_compression == "stored" else (zipfile.ZIP_DEFLATED, config.get('zip_level', 6))
+
+def write_zip_entry(zip_file_object, arcname, data, config):
+    compress_type, compress_level = zip_compression_for(arcname, config)
+    zip_info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6]); zip_info.compress_type = compress_type
+    zip_file_object.writestr(zip_info, data, compress_type=compress_type, compresslevel=compress_level)
+
+def _run_task(task, status_callback):
+    # task[8] is the batch-converted PNG (or None), task[9] the cached watermark (x, y) positions (or None).
+    placement_plan = PlacementPlan(task[9])
+    if not task[7].get('metrics'): return process_single_file(*task[:8], status_callback=status_callback, preconverted_png_path=task[8], placement_plan=placement_plan) + (None, placement_plan)
+    with measuring_stages() as file_metrics: success, output_file_path = process_single_file(*task[:8], status_callback=status_callback, preconverted_png_path=task[8], placement_plan=placement_plan)
+    return success, output_file_path, dict(file_metrics.as_dict(), seconds=round(file_metrics.total, 6)), placement_plan
+
+def _process_file_worker(task):
+    global _worker_profiler
+    messages = []; file_metrics = None; placement_plan = None; profile_dir = task[7].get('profile_dir')
+    if task[3] is None: task = task[:3] + (_worker_watermark,) + task[4:]
+    if profile_dir:
+        if _worker_profiler is None: _worker_profiler = cProfile.Profile()
+        _worker_profiler.enable()
+    try: success, output_file_path, file_metrics, placement_plan = _run_task(task, messages.append)
+    except Exception as e:
+        messages.append(f"  ! Worker error: {type(e).__name__}: {e}"); success, output_file_path = False, None
+        print(f"--- WORKER ERROR for {task[0]} ---\n{traceback.format_exc()}\n--- END ERROR ---")
+    finally:
+        if profile_dir: _worker_profiler.disable(); _worker_profiler.dump_stats(os.path.join(profile_dir, f"worker_{os.getpid()}.prof"))
+    return success, output_file_path, messages, file_metrics, placement_plan
+
+def _finished_cleanly(future):
+    return future.done() and not future.cancelled() and future.exception() is None
+
+class OrderedProcessPool:
+    def __init__(self, workers, initializer=None, initargs=()):
+        self.workers = workers; self.initializer = initializer; self.initargs = initargs; self._executor = None; self._lock = threading.Lock()
+
+    def _create_executor(self, max_workers):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"), initializer=self.initializer, initargs=self.initargs)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None: self._executor = self._create_executor(self.workers)
+            return self._executor
+
+    def _submit(self, func, task):
+        while True:
+            executor = self._get_executor()
+            try: return executor.submit(func, task), executor
+            except BrokenProcessPool: self._reset_executor(executor)
+
+    def _reset_executor(self, broken_executor):
+        # Several callers can see the same broken pool; only the first one replaces it.
+        with self._lock:
+            if self._executor is not broken_executor: return
+            self._executor = None
+        try: broken_executor.shutdown(wait=False, cancel_futures=True)
+        except Exception as e: print(f"Warning: Error shutting down broken worker pool: {e}")
+
+    def _run_isolated(self, func, task):
+        isolated_executor = self._create_executor(1)
+        try: return isolated_executor.submit(func, task).result()
+        except BrokenProcessPool: return None
+        finally: isolated_executor.shutdown(wait=True)
+
+    def map_ordered(self, func, tasks, submit_order=None):
+        # Yields one result per task in task order; None marks a task whose worker process died. submit_order (task indexes) only
+        # changes the order in which the workers pick the tasks up.
+        # A broken pool is rebuilt, the failing task is re-run alone in its own process to find the culprit, and the rest is resubmitted.
+        tasks = list(tasks); submissions = [None] * len(tasks); index = 0
+        for task_index in (range(len(tasks)) if submit_order is None else submit_order): submissions[task_index] = self._submit(func, tasks[task_index])
+        while index < len(tasks):
+            future, executor = submissions[index]
+            try: result = future.result()
+            except BrokenProcessPool:
+                self._reset_executor(executor); result = self._run_isolated(func, tasks[index])
+                submissions[index + 1:] = [submission if _finished_cleanly(submission[0]) else self._submit(func, task) for submission, task in zip(submissions[index + 1:], tasks[index + 1:])]
+            except Exception as e:
+                print(f"--- POOL ERROR for task {index} ---\n{traceback.format_exc()}\n--- END ERROR ---")
+                result = (False, None, [f"  ! Worker error: {type(e).__name__}: {e}"], None, None)
+            yield result; index += 1
+
+    def shutdown(self):
+        with self._lock: executor = self._executor; self._executor = None
+        if executor is not None: executor.shutdown(wait=True, cancel_futures=True)
+
+def check_area_uniformity(image, x, y, width, height, threshold):
+    try:
+        with image.crop((x, y, x + width, y + height)) as area:
+            area_gray = area.convert('L'); stat = ImageStat.Stat(area_gray)
+            min_val, max_val = stat.extrema[0]; difference = max_val - min_val
+            return difference <= threshold
+    except Exception as e: print(f"  Warning: Error checking uniformity at ({x},{y}): {e}"); return False
+
+class ClassicUniformitySearch:
+    def __init__(self, main_img, x, width, height, threshold):
+        self.main_img = main_img; self.x = x; self.width = width; self.height = height; self.threshold = threshold
+
+    def first_uniform(self, candidates):
+        with metrics_stage("search"):
+            for checked, y in enumerate(candidates, 1):
+                if check_area_uniformity(self.main_img, self.x, y, self.width, self.height, self.threshold): metrics_count("candidates", checked); return y
+            metrics_count("candidates", len(candidates)); return -1
+
+    def find_spot(self, candidates):
+        placement_y = self.first_uniform(candidates)
+        return (self.x, placement_y) if placement_y != -1 else None
+
+    def refresh(self, y, height): pass
+
+def _sliding_window_reduce(values, window, reduce_ufunc):
+    # van Herk / Gil-Werman: per-block prefix and suffix reductions give every window in O(n), independent of the window size.
+    count = len(values) - window + 1
+    if count <= 0: return values[:0].copy()
+    if window == 1: return values.copy()
+    pad = (-len(values)) % window
+    blocks = np.concatenate([values, np.repeat(values[-1:], pad)]).reshape(-1, window)
+    prefix = reduce_ufunc.accumulate(blocks, axis=1).ravel()
+    suffix = reduce_ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    return reduce_ufunc(suffix[:count], prefix[window - 1:window - 1 + count])
+
+class SlidingWindowUniformitySearch:
+    def __init__(self, main_img, x, width, height, threshold):
+        self.main_img = main_img; self.x = x; self.width = width; self.height = height; self.threshold = threshold
+        with main_img.crop((x, 0, x + width, main_img.size[1])) as strip, strip.convert('L') as strip_gray:
+            strip_array = np.asarray(strip_gray)
+        self.row_min = strip_array.min(axis=1); self.row_max = strip_array.max(axis=1)
+        self.uniform = self._window_uniformity(0, len(self.row_min))
+
+    def _window_uniformity(self, row_start, row_stop):
+        window_min = _sliding_window_reduce(self.row_min[row_start:row_stop], self.height, np.minimum)
+        window_max = _sliding_window_reduce(self.row_max[row_start:row_stop], self.height, np.maximum)
+        return (window_max.astype(np.int16) - window_min) <= self.threshold
+
+    def first_uniform(self, candidates):
+        with metrics_stage("search"):
+            candidates = np.asarray(candidates, dtype=np.int64)
+            candidates = candidates[(candidates >= 0) & (candidates < len(self.uniform))]
+            hits = np.flatnonzero(self.uniform[candidates])
+            metrics_count("candidates", int(hits[0]) + 1 if len(hits) else len(candidates))
+            return int(candidates[hits[0]]) if len(hits) else -1
+
+    def find_spot(self, candidates):
+        placement_y = self.first_uniform(candidates)
+        return (self.x, placement_y) if placement_y != -1 else None
+
+    def refresh(self, y, height):
+        # Re-read rows changed by a paste so later searches see the same pixels as the classic engine.
+        row_stop = min(y + height, len(self.row_min))
+        with self.main_img.crop((self.x, y, self.x + self.width, row_stop)) as area, area.convert('L') as area_gray:
+            area_array = np.asarray(area_gray)
+        self.row_min[y:row_stop] = area_array.min(axis=1); self.row_max[y:row_stop] = area_array.max(axis=1)
+        window_start = max(0, y - self.height + 1); window_stop = min(len(self.uniform), row_stop)
+        self.uniform[window_start:window_stop] = self._window_uniformity(window_start, window_stop + self.height - 1)
+
+def _integral_image(values):
+    integral = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(values, axis=0, dtype=np.int64), axis=1, out=integral[1:, 1:]); return integral
+
+def _window_sums(integral, height, width):
+    # Sum of every height x width window, four lookups each.
+    return integral[height:, width:] - integral[:-height, width:] - integral[height:, :-width] + integral[:-height, :-width]
+
+class VarianceUniformitySearch:
+    # Scores every watermark-sized rectangle between the right edge and band px to its left by the standard deviation of its
+    # gray levels, read from summed-area tables of the searched rows. Areas up to threshold / 2 pass, which every area within
+    # the min/max range threshold does; of those, the calmest one wins (ties go to the rightmost, then the topmost spot).
+    def __init__(self, main_img, x, width, height, threshold, band=0):
+        self.main_img = main_img; self.x = x; self.width = width; self.height = height; self.threshold = threshold; self.x_start = max(0, x - band)
+
+    def find_spot(self, candidates):
+        with metrics_stage("search"):
+            candidates = [y for y in candidates if 0 <= y <= self.main_img.size[1] - self.height]
+            if not candidates: return None
+            first_y = min(candidates); last_y = max(candidates)
+            with self.main_img.crop((self.x_start, first_y, self.x + self.width, last_y + self.height)) as area, area.convert('L') as area_gray:
+                gray = np.asarray(area_gray).astype(np.uint16)
+            window_sum = _window_sums(_integral_image(gray), self.height, self.width); window_square_sum = _window_sums(_integral_image(gray * gray), self.height, self.width)
+            # pixel_count ** 2 * variance, exact in integers.
+            pixel_count = self.width * self.height; window_square_sum *= pixel_count; window_sum *= window_sum; window_square_sum -= window_sum
+            # Columns from the right edge inward, rows top down, so the first minimum is the rightmost and then the topmost.
+            scaled_variance = window_square_sum[:, ::-1].T
+            metrics_count("candidates", scaled_variance.size)
+            column, row = divmod(int(np.argmin(scaled_variance)), scaled_variance.shape[1])
+            if 4 * int(scaled_variance[column, row]) > self.threshold ** 2 * pixel_count ** 2: return None
+            return (self.x - column, first_y + row)
+
+    def refresh(self, y, height): pass
+
+def search_x_start(main_w, wm_w, config):
+    # Leftmost column a watermark may start at; only the variance engine searches left of the right edge.
+    if config.get('search_engine') == "variance" and get_numpy() is not None: return max(0, main_w - wm_w - config.get('search_band', 0))
+    return main_w - wm_w
+
+def _position_label(position, edge_x):
+    return f"Y={position[1]}" if position[0] == edge_x else f"X={position[0]}, Y={position[1]}"
+
+def create_uniformity_search(main_img, watermark, config):
+    main_w = main_img.size[0]; wm_w, wm_h = watermark.size
+    engine = config.get('search_engine', "classic")
+    if engine == "variance" and get_numpy() is not None: return VarianceUniformitySearch(main_img, main_w - wm_w, wm_w, wm_h, config['threshold'], config.get('search_band', 0))
+    if engine == "sliding" and get_numpy() is not None:
+        with metrics_stage("search"): return SlidingWindowUniformitySearch(main_img, main_w - wm_w, wm_w, wm_h, config['threshold'])
+    return ClassicUniformitySearch(main_img, main_w - wm_w, wm_w, wm_h, config['threshold'])
+
+def _search_sees_watermark(placed_positions, start_y, main_h, wm_h, config):
+    # Whether the rows searched for the interval at start_y reach into a watermark pasted for an earlier interval,
+    # in which case the spot found there depends on that artwork's pixels.
+    last_candidate_y = start_y + min(config['max_steps'], max(0, (min(start_y + config['frequency'], main_h - wm_h) - start_y) // config['search_step'])) * config['search_step']
+    return any(y < last_candidate_y + wm_h and start_y < y + wm_h for _, y in placed_positions)
+
+def search_and_place_watermark(main_img, watermark_img, config, start_y, max_search_y, uniformity_search=None):
+    watermark = watermark_img if isinstance(watermark_img, PreparedWatermark) else PreparedWatermark(watermark_img)
+    main_w, main_h = main_img.size; wm_w, wm_h = watermark.size
+    placement_x = main_w - wm_w; placement = None
+    if start_y < 0: start_y = 0
+    if placement_x < 0: return None
+    if uniformity_search is None: uniformity_search = ClassicUniformitySearch(main_img, placement_x, wm_w, wm_h, config['threshold'])
+    if start_y + wm_h <= main_h:
+        effective_max_y = min(max_search_y, main_h - wm_h)
+        candidates = [start_y] + list(range(start_y + config['search_step'], effective_max_y + 1, config['search_step']))[:config['max_steps']]
+        placement = uniformity_search.find_spot(candidates)
+    if placement is not None:
+        try:
+            watermark.paste_onto(main_img, placement)
+            with metrics_stage("search"): uniformity_search.refresh(placement[1], wm_h)
+            return placement
+        except Exception as e: print(f"  ERROR pasting watermark at {_position_label(placement, placement_x)}: {e}"); return None
+    else: return None
+
+def _copy_source_output(source_copy_path, output_final_path, output_label, status_callback):
+    try:
+        with metrics_stage("copy"):
+            if isinstance(output_final_path, str): shutil.copy2(source_copy_path, output_final_path)
+            else:
+                with open(source_copy_path, 'rb') as source_file: shutil.copyfileobj(source_file, output_final_path)
+        return True
+    except Exception as e: status_callback(f"  ! Error copying source: {e}"); print(f"--- ERROR COPYING SOURCE {source_copy_path} to {output_label} ---\n{traceback.format_exc()}\n--- END ERROR ---"); return False
+
+def write_watermarked_output(main_img, watermarks_added_count, output_final_path, output_format, config, status_callback, source_copy_path=None):
+    output_label = output_final_path if isinstance(output_final_path, str) else "<in-memory output>"
+    output_format = output_format or (output_format_for(output_final_path) if isinstance(output_final_path, str) else "PNG")
+    # Pages that end up without a watermark are copied byte for byte when the source already has the output format.
+    if source_copy_path and OUTPUT_FORMATS_BY_EXTENSION.get(os.path.splitext(source_copy_path)[1].lower()) != output_format: source_copy_path = None
+    output_dir = os.path.dirname(output_final_path) if isinstance(output_final_path, str) else None
+    if output_dir:
+        try: os.makedirs(output_dir, exist_ok=True)
+        except OSError as e: status_callback(f"  ! Error creating folder '{output_dir}': {e}"); return False
+    if watermarks_added_count == 0 and source_copy_path: return _copy_source_output(source_copy_path, output_final_path, output_label, status_callback)
+    try: save_output_image(main_img, output_final_path, output_format, config); return True
+    except Exception as e: status_callback(f"  ! Error saving result: {e}"); print(f"--- ERROR SAVING RESULT for {output_label} ---\n{traceback.format_exc()}\n--- END ERROR ---"); return False
+
+def add_watermarks_to_image(input_image, watermark, output_final_path, config, status_callback, source_copy_path=None, output_format=None, placement_plan=None):
+    if isinstance(input_image, str): source_copy_path = input_image
+    image_label = os.path.basename(source_copy_path or (output_final_path if isinstance(output_final_path, str) else "<in-memory output>"))
+    try:
+        main_img = open_image_rgba(input_image) if isinstance(input_image, str) else input_image
+        if not isinstance(watermark, PreparedWatermark): watermark = PreparedWatermark.from_path(watermark)
+        main_w, main_h = main_img.size; wm_w, wm_h = watermark.size
+        watermarks_added_count = 0; placed_positions = []; edge_x = main_w - wm_w
+        if not watermark.fits(main_w, main_h): status_callback(f"  - Watermark larger than image.")
+        elif placement_plan is not None and placement_plan.cached_positions is not None:
+            for position in placement_plan.cached_positions: position = tuple(position); watermark.paste_onto(main_img, position); placed_positions.append(position); status_callback(f"  + Watermark ({_position_label(position, edge_x)}, cached)")
+            watermarks_added_count = len(placed_positions)
+        elif main_h < config['frequency']:
+            search_position = create_uniformity_search(main_img, watermark, config).find_spot(range(0, main_h - wm_h + 1, SHORT_IMAGE_SEARCH_STEP))
+            if search_position is not None:
+                try: watermark.paste_onto(main_img, search_position); watermarks_added_count = 1; placed_positions.append(search_position); status_callback(f"  + Watermark ({_position_label(search_position, edge_x)})")
+                except Exception as e: status_callback(f"  ! Error applying watermark ({_position_label(search_position, edge_x)}): {e}")
+            else: status_callback(f"  - Spot not found (short image).")
+        else:
+            current_y_target = config['frequency']; uniformity_search = create_uniformity_search(main_img, watermark, config)
+            while current_y_target < main_h:
+                if current_y_target + wm_h <= main_h:
+                    max_y_for_interval_search = current_y_target + config['frequency']
+                    if placement_plan is not None and _search_sees_watermark(placed_positions, current_y_target, main_h, wm_h, config): placement_plan.saw_watermark = True
+                    placement = search_and_place_watermark(main_img, watermark, config, current_y_target, max_y_for_interval_search, uniformity_search)
+                    if placement is not None: watermarks_added_count += 1; placed_positions.append(placement); status_callback(f"  + Watermark ({_position_label(placement, edge_x)})")
+                else: break
+                current_y_target += config['frequency']
+        if placement_plan is not None: placement_plan.positions = placed_positions; placement_plan.page_size = (main_w, main_h)
+        if output_final_path is None: return True
+        return write_watermarked_output(main_img, watermarks_added_count, output_final_path, output_format, config, status_callback, source_copy_path)
+    except FileNotFoundError: status_callback(f"  ! Error: PNG '{image_label}' or watermark not found."); return False
+    except UnidentifiedImageError: status_callback(f"  ! Error: Could not identify PNG format '{image_label}'."); return False
+    except Exception as e: status_callback(f"  ! Error processing PNG '{image_label}': {type(e).__name__}"); print(f"--- WATERMARKING ERROR for {image_label} ---\n{traceback.format_exc()}\n--- END ERROR ---"); return False
+    finally:
+        if isinstance(input_image, str) and 'main_img' in locals(): main_img.close()
+
+def reset_peak_memory():
+    # Linux can reset the peak RSS of the process, which gives a per-file peak; elsewhere the process-wide peak is reported.
+    try:
+        with open("/proc/self/clear_refs", 'w') as clear_refs: clear_refs.write("5")
+        return True
+    except OSError: return False
+
+def peak_memory_bytes():
+    try:
+        with open("/proc/self/status", 'r') as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"): return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError): pass
+    try:
+        import resource
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+    except ImportError: pass
+    try: import psutil; return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError): return None
+
+def _png_chunk(chunk_type, data): return b"".join((struct.pack(">I", len(data)), chunk_type, data, struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff)))
+
+def _iter_png_chunks(png_file):
+    if png_file.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE: raise ValueError("not a PNG file")
+    while True:
+        chunk_header = png_file.read(8)
+        if len(chunk_header) < 8: raise ValueError("truncated PNG file")
+        chunk_length, chunk_type = struct.unpack(">I4s", chunk_header)
+        chunk_data = png_file.read(chunk_length); png_file.read(4)
+        if len(chunk_data) < chunk_length: raise ValueError("truncated PNG file")
+        yield chunk_type, chunk_data
+        if chunk_type == b"IEND": return
+
+class PngBandReader:
+    # Decodes a non-interlaced 8-bit PNG a band of rows at a time. Each band is handed to Pillow as a small PNG that starts
+    # with the last row of the previous band, so the row filters are undone against the same data as in the full image.
+    def __init__(self, png_path, header, extra_chunks, icc_chunk):
+        self.path = png_path; self.width, self.height, self.bit_depth, self.color_type = header
+        self.size = (self.width, self.height); self.extra_chunks = extra_chunks; self.icc_chunk = icc_chunk
+        self.row_bytes = self.width * PNG_STREAM_CHANNELS[self.color_type]
+
+    @classmethod
+    def open(cls, png_path):
+        extra_chunks = []; icc_chunk = None; header = None
+        with open(png_path, 'rb') as png_file:
+            for chunk_type, chunk_data in _iter_png_chunks(png_file):
+                if chunk_type == b"IHDR":
+                    width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", chunk_data)
+                    if bit_depth != 8 or interlace != 0 or color_type not in PNG_STREAM_CHANNELS: return None
+                    header = (width, height, bit_depth, color_type)
+                elif chunk_type in (b"PLTE", b"tRNS"): extra_chunks.append((chunk_type, chunk_data))
+                elif chunk_type == b"iCCP": icc_chunk = chunk_data
+                elif chunk_type in (b"IDAT", b"IEND"): break
+        return cls(png_path, header, extra_chunks, icc_chunk) if header else None
+
+    def _iter_scanline_data(self):
+        decompressor = zlib.decompressobj()
+        with open(self.path, 'rb') as png_file:
+            for chunk_type, chunk_data in _iter_png_chunks(png_file):
+                if chunk_type != b"IDAT": continue
+                while chunk_data:
+                    scanline_data = decompressor.decompress(chunk_data, PNG_STREAM_READ_SIZE); chunk_data = decompressor.unconsumed_tail
+                    if scanline_data: yield scanline_data
+        scanline_data = decompressor.flush()
+        if scanline_data: yield scanline_data
+
+    def _decode_band(self, previous_row, scanlines, rows):
+        prefix = b"\x00" + previous_row if previous_row is not None else b""; band_height = rows + (1 if previous_row is not None else 0)
+        band_header = struct.pack(">IIBBBBB", self.width, band_height, self.bit_depth, self.color_type, 0, 0, 0)
+        band_png = PNG_SIGNATURE + _png_chunk(b"IHDR", band_header) + b"".join(_png_chunk(chunk_type, chunk_data) for chunk_type, chunk_data in self.extra_chunks) + _png_chunk(b"IDAT", zlib.compress(prefix + scanlines, 0)) + _png_chunk(b"IEND", b"")
+        with metrics_stage("decode"): band = Image.open(io.BytesIO(band_png)); band.load()
+        return band.crop((0, 1, self.width, band_height)) if previous_row is not None else band
+
+    def iter_bands(self, band_rows):
+        stride = self.row_bytes + 1; pending = bytearray(); previous_row = None; row = 0
+        for scanline_data in self._iter_scanline_data():
+            pending += scanline_data
+            while row < self.height and len(pending) >= min(band_rows, self.height - row) * stride:
+                rows = min(band_rows, self.height - row); band_size = rows * stride
+                band = self._decode_band(previous_row, bytes(pending[:band_size]), rows); del pending[:band_size]
+                with band.crop((0, rows - 1, self.width, rows)) as last_row: previous_row = last_row.tobytes()
+                row += rows; yield band
+        if row < self.height: raise ValueError(f"PNG data ended at row {row} of {self.height}")
+
+class PngStreamWriter:
+    # Writes an 8-bit RGBA PNG band by band. Pillow picks the row filters for each band; the first row of a band is stored
+    # unfiltered because Pillow filtered it against an empty row.
+    def __init__(self, output_file, width, height, compress_level, icc_chunk=None):
+        self.output_file = output_file; self.width = width; self.compressor = zlib.compressobj(compress_level)
+        output_file.write(PNG_SIGNATURE + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        if icc_chunk: output_file.write(_png_chunk(b"iCCP", icc_chunk))
+
+    def _write_idat(self, data):
+        if data: self.output_file.write(_png_chunk(b"IDAT", data))
+
+    def write_band(self, band):
+        with metrics_stage("encode"): self._write_band(band)
+
+    def _write_band(self, band):
+        encoded_band = io.BytesIO(); band.save(encoded_band, "PNG", compress_level=0); encoded_band.seek(0)
+        scanlines = memoryview(zlib.decompress(b"".join(chunk_data for chunk_type, chunk_data in _iter_png_chunks(encoded_band) if chunk_type == b"IDAT")))
+        stride = self.width * 4 + 1
+        with band.crop((0, 0, self.width, 1)) as first_row: self._write_idat(self.compressor.compress(b"\x00" + first_row.tobytes()))
+        self._write_idat(self.compressor.compress(scanlines[stride:]))
+
+    def close(self):
+        self._write_idat(self.compressor.flush()); self.output_file.write(_png_chunk(b"IEND", b""))
+
+class _ColumnStream:
+    # Hands out the searched right-edge column of streamed bands in order, keeping at most one band of it in memory.
+    def __init__(self, bands, x, width):
+        self.bands = bands; self.x = x; self.width = width; self.buffer = None; self.position = 0
+
+    def read(self, rows):
+        column = Image.new("RGBA", (self.width, rows)); filled = 0
+        while filled < rows:
+            if self.buffer is None:
+                with next(self.bands) as band, band.crop((self.x, 0, self.x + self.width, band.height)) as band_column: self.buffer = band_column.convert("RGBA")
+            take = min(rows - filled, self.buffer.height)
+            with self.buffer.crop((0, 0, self.width, take)) as part: column.paste(part, (0, filled))
+            self.buffer = self.buffer.crop((0, take, self.width, self.buffer.height)) if take < self.buffer.height else None
+            filled += take
+        self.position += rows
+        return column
+
+    def skip(self, rows):
+        skipped = 0
+        while skipped < rows:
+            if self.buffer is None:
+                with next(self.bands) as band, band.crop((self.x, 0, self.x + self.width, band.height)) as band_column: self.buffer = band_column.convert("RGBA")
+            take = min(rows - skipped, self.buffer.height)
+            self.buffer = self.buffer.crop((0, take, self.width, self.buffer.height)) if take < self.buffer.height else None
+            skipped += take
+        self.position += rows
+
+def plan_streamed_placements(column_stream, main_h, watermark, config, status_callback, placement_plan=None):
+    # Same placement rules as add_watermarks_to_image, but each interval is searched in a window of the right-edge column
+    # that is at most frequency + watermark height rows tall. Rows a paste reaches past the window are carried over.
+    # Positions in the column are shifted by its x to page coordinates.
+    wm_h = watermark.height; frequency = config['frequency']; placements = []; edge_x = column_stream.x + column_stream.width - watermark.width
+    if main_h < frequency:
+        with column_stream.read(main_h) as column:
+            search_position = create_uniformity_search(column, watermark, config).find_spot(range(0, main_h - wm_h + 1, SHORT_IMAGE_SEARCH_STEP))
+        if search_position is not None: placements.append((column_stream.x + search_position[0], search_position[1])); status_callback(f"  + Watermark ({_position_label(placements[-1], edge_x)})")
+        else: status_callback("  - Spot not found (short image).")
+        return placements
+    column_stream.skip(frequency); current_y_target = frequency; carry = None
+    while current_y_target < main_h and current_y_target + wm_h <= main_h:
+        window_stop = min(main_h, current_y_target + frequency + wm_h)
+        with column_stream.read(window_stop - column_stream.position) as fresh_rows:
+            window = Image.new("RGBA", (column_stream.width, window_stop - current_y_target))
+            if carry is not None: window.paste(carry, (0, 0)); carry.close()
+            window.paste(fresh_rows, (0, window.height - fresh_rows.height))
+        if placement_plan is not None and _search_sees_watermark(placements, current_y_target, main_h, wm_h, config): placement_plan.saw_watermark = True
+        placement = search_and_place_watermark(window, watermark, config, 0, frequency, create_uniformity_search(window, watermark, config))
+        if placement is not None: placements.append((column_stream.x + placement[0], current_y_target + placement[1])); status_callback(f"  + Watermark ({_position_label(placements[-1], edge_x)})")
+        carry = window.crop((0, frequency, column_stream.width, window.height)) if window.height > frequency else None
+        window.close(); current_y_target += frequency
+    if carry is not None: carry.close()
+    return placements
+
+def strip_band_rows(width, config, reserved_bytes=0):
+    band_budget = config.get('memory_budget', 0) * 1024 * 1024 - reserved_bytes
+    return max(STRIP_MIN_BAND_ROWS, band_budget // (width * 4 * STRIP_BAND_COPIES))
+
+def add_watermarks_to_png_bands(reader, watermark, output_final_path, config, status_callback, source_copy_path=None, placement_plan=None):
+    # Memory-bounded counterpart of add_watermarks_to_image for PNG input. The page is decoded twice, band by band:
+    # the first pass only keeps the searched right-edge column to find the spots, the second pastes and encodes each band.
+    output_label = output_final_path if isinstance(output_final_path, str) else "<in-memory output>"
+    image_label = os.path.basename(source_copy_path or output_label)
+    if source_copy_path and OUTPUT_FORMATS_BY_EXTENSION.get(os.path.splitext(source_copy_path)[1].lower()) != "PNG": source_copy_path = None
+    try:
+        if not isinstance(watermark, PreparedWatermark): watermark = PreparedWatermark.from_path(watermark)
+        main_w, main_h = reader.size; wm_w, wm_h = watermark.size; placements = []; column_x = search_x_start(main_w, wm_w, config)
+        window_bytes = min(main_h, config['frequency'] + wm_h) * (main_w - column_x) * 4 * 2
+        band_rows = strip_band_rows(main_w, config, window_bytes)
+        status_callback(f"  Streaming in bands of {band_rows} rows...")
+        if not watermark.fits(main_w, main_h): status_callback("  - Watermark larger than image.")
+        elif placement_plan is not None and placement_plan.cached_positions is not None:
+            placements = [tuple(position) for position in placement_plan.cached_positions]
+            for position in placements: status_callback(f"  + Watermark ({_position_label(position, main_w - wm_w)}, cached)")
+        else:
+            search_bands = reader.iter_bands(band_rows)
+            try: placements = plan_streamed_placements(_ColumnStream(search_bands, column_x, main_w - column_x), main_h, watermark, config, status_callback, placement_plan)
+            finally: search_bands.close()
+        if placement_plan is not None: placement_plan.positions = placements; placement_plan.page_size = (main_w, main_h)
+        if output_final_path is None: return True
+
+        output_dir = os.path.dirname(output_final_path) if isinstance(output_final_path, str) else None
+        if output_dir:
+            try: os.makedirs(output_dir, exist_ok=True)
+            except OSError as e: status_callback(f"  ! Error creating folder '{output_dir}': {e}"); return False
+        if not placements and source_copy_path: return _copy_source_output(source_copy_path, output_final_path, output_label, status_callback)
+        try:
+            with (open(output_final_path, 'wb') if isinstance(output_final_path, str) else contextlib.nullcontext(output_final_path)) as output_file:
+                writer = PngStreamWriter(output_file, main_w, main_h, PNG_STREAM_COMPRESS_LEVELS.get(config.get('output_profile'), 6), reader.icc_chunk); band_top = 0
+                for band in reader.iter_bands(band_rows):
+                    band_rgba = band if band.mode == "RGBA" else band.convert("RGBA")
+                    for placement_x, placement_y in placements:
+                        if placement_y < band_top + band.height and placement_y + wm_h > band_top: watermark.paste_onto(band_rgba, (placement_x, placement_y - band_top))
+                    writer.write_band(band_rgba); band_top += band.height
+                    band_rgba.close(); band.close()
+                writer.close()
+            return True
+        except Exception as e: status_callback(f"  ! Error saving result: {e}"); print(f"--- ERROR SAVING RESULT for {output_label} ---\n{traceback.format_exc()}\n--- END ERROR ---"); return False
+    except Exception as e: status_callback(f"  ! Error processing PNG '{image_label}': {type(e).__name__}"); print(f"--- WATERMARKING ERROR for {image_label} ---\n{traceback.format_exc()}\n--- END ERROR ---"); return False
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""): file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def search_settings_key(config):
+    # The range engines (classic, sliding) pick the same spots, so they share a key; the variance engine and its band do not.
+    return {"uniformity": "variance", "search_band": config.get('search_band', 0)} if config.get('search_engine') == "variance" and get_numpy() is not None else {"uniformity": "range"}
+
+def node_temp_path(path, suffix=".tmp"):
+    # Unique per machine and process, so workers sharing an output folder never write into each other's temporary file.
+    return f"{path}.{socket.gethostname()}-{os.getpid()}{suffix}"
+
+def _merge_saved_entries(path, version, entries, changes):
+    # Several job workers can save the same file; start from what is on disk now and replay this process's changes on top.
+    try:
+        with open(path, 'r', encoding='utf-8') as f: saved_data = json.load(f)
+        if saved_data.get("version") == version: entries = saved_data.get("entries", {})
+    except (OSError, ValueError): pass
+    for key, value in changes.items():
+        if value is None: entries.pop(key, None)
+        else: entries[key] = value
+    return entries
+
+class RunManifest:
+    # Maps each output (relative to the output folder) to the source fingerprint, watermark hash and
+    # effective config it was produced from. It is saved while the run goes, so an interrupted batch resumes.
+    # The PSD reader and transfer mode change the pixels of PSD pages only, so they are part of the key for PSD runs.
+    def __init__(self, main_output_dir, watermark_path, config, process_type="png"):
+        self.main_output_dir = main_output_dir; self.path = os.path.join(main_output_dir, MANIFEST_FILENAME)
+        self.hash_sources = config.get('hash_sources', False); self.watermark_hash = hash_file(watermark_path)
+        config_keys = OUTPUT_CONFIG_KEYS + (PSD_OUTPUT_CONFIG_KEYS if process_type == "psd" else ())
+        self.config_hash = hashlib.sha256(json.dumps(dict({key: config.get(key) for key in config_keys}, **search_settings_key(config)), sort_keys=True).encode('utf-8')).hexdigest()
+        self.entries = {}; self._changes = {}; self._last_save = time.monotonic(); self._lock = threading.Lock()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f: manifest_data = json.load(f)
+            if manifest_data.get("version") == MANIFEST_VERSION: self.entries = manifest_data.get("entries", {})
+        except FileNotFoundError: pass
+        except Exception as e: print(f"Warning: Could not read manifest '{self.path}', starting fresh: {e}")
+
+    def key_for(self, output_file_path):
+        return os.path.relpath(output_file_path, self.main_output_dir).replace(os.sep, '/')
+
+    def fingerprint(self, source_path):
+        try:
+            stat_result = os.stat(source_path)
+            if self.hash_sources: return {"size": stat_result.st_size, "sha256": hash_file(source_path)}
+            return {"size": stat_result.st_size, "mtime_ns": stat_result.st_mtime_ns}
+        except OSError: return None
+
+    def _entry(self, source_fingerprint):
+        return {"source": source_fingerprint, "watermark": self.watermark_hash, "config": self.config_hash}
+
+    def is_current(self, output_key, source_fingerprint):
+        with self._lock: return source_fingerprint is not None and self.entries.get(output_key) == self._entry(source_fingerprint)
+
+    def record(self, output_key, source_fingerprint):
+        with self._lock: self.entries[output_key] = self._changes[output_key] = self._entry(source_fingerprint)
+        self.save(force=False)
+
+    def forget(self, output_key):
+        with self._lock:
+            if self.entries.pop(output_key, None) is not None: self._changes[output_key] = None
+
+    def save(self, force=True):
+        with self._lock:
+            if not self._changes or (not force and time.monotonic() - self._last_save < MANIFEST_SAVE_INTERVAL_SECONDS): return
+            temp_path = node_temp_path(self.path)
+            try:
+                self.entries = _merge_saved_entries(self.path, MANIFEST_VERSION, self.entries, self._changes)
+                with open(temp_path, 'w', encoding='utf-8') as f: json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, f, ensure_ascii=False)
+                os.replace(temp_path, self.path); self._changes = {}; self._last_save = time.monotonic()
+            except Exception as e: print(f"Warning: Could not save manifest '{self.path}': {e}")
+
+class PlacementPlan:
+    # Carries the cached watermark positions of a page into the worker and the positions that were used back out.
+    # saw_watermark marks a search that looked at a watermark pasted earlier on the page.
+    def __init__(self, cached_positions=None):
+        self.cached_positions = cached_positions; self.positions = None; self.page_size = None; self.saw_watermark = False
+
+class PlacementCache:
+    # Watermark positions per page, keyed by the page's content hash, the watermark size and the search settings. The artwork
+    # itself is not part of the key, so after a watermark swap only the paste and encode run. A plan-only run fills it too.
+    def __init__(self, main_output_dir, watermark_size, config):
+        self.path = os.path.join(main_output_dir, PLACEMENT_CACHE_FILENAME); self.watermark_size = watermark_size
+        self.settings_hash = hashlib.sha256(json.dumps(dict({key: config.get(key) for key in PLACEMENT_KEY_CONFIG_KEYS}, watermark_size=list(watermark_size), **search_settings_key(config)), sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        self.entries = {}; self._changes = {}; self.pages = []; self.hits = 0; self._last_save = time.monotonic(); self._lock = threading.Lock()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f: cache_data = json.load(f)
+            if cache_data.get("version") == PLACEMENT_CACHE_VERSION: self.entries = cache_data.get("entries", {})
+        except FileNotFoundError: pass
+        except Exception as e: print(f"Warning: Could not read placement cache '{self.path}', starting fresh: {e}")
+
+    def key_for(self, page_hash):
+        return f"{page_hash}:{self.settings_hash}" if page_hash else None
+
+    def lookup(self, page_key):
+        with self._lock: return self.entries.get(page_key) if page_key else None
+
+    def add_page(self, folder_name, filename, page_key, placement_plan):
+        with self._lock:
+            was_cached = placement_plan.cached_positions is not None; self.hits += was_cached
+            self.pages.append((folder_name, filename, placement_plan.page_size, placement_plan.positions, was_cached))
+            # A search that looked at an earlier watermark judged the spots with that artwork's pixels, so such pages are not cached.
+            if was_cached or not page_key or placement_plan.saw_watermark: return
+            self.entries[page_key] = self._changes[page_key] = [list(position) for position in placement_plan.positions]
+        self.save(force=False)
+
+    def save(self, force=True):
+        with self._lock:
+            if not self._changes or (not force and time.monotonic() - self._last_save < MANIFEST_SAVE_INTERVAL_SECONDS): return
+            temp_path = node_temp_path(self.path)
+            try:
+                self.entries = _merge_saved_entries(self.path, PLACEMENT_CACHE_VERSION, self.entries, self._changes)
+                with open(temp_path, 'w', encoding='utf-8') as f: json.dump({"version": PLACEMENT_CACHE_VERSION, "entries": self.entries}, f)
+                os.replace(temp_path, self.path); self._changes = {}; self._last_save = time.monotonic()
+            except Exception as e: print(f"Warning: Could not save placement cache '{self.path}': {e}")
+
+    def write_plan(self, main_output_dir):
+        plan_path = os.path.join(main_output_dir, PLAN_FILENAME)
+        with open(plan_path, 'w', encoding='utf-8', newline='') as plan_file:
+            plan_writer = csv.writer(plan_file); plan_writer.writerow(["folder", "file", "width", "height", "x_positions", "y_positions", "cached"])
+            for folder_name, filename, page_size, positions, was_cached in sorted(self.pages, key=lambda page: page[:2]):
+                page_w, page_h = page_size or ("", "")
+                plan_writer.writerow([folder_name, filename, page_w, page_h, " ".join(str(position[0]) for position in positions), " ".join(str(position[1]) for position in positions), was_cached])
+        return plan_path
+
+class _PipelinePage:
+    def __init__(self, filename, task):
+        self.filename = filename; self.task = task; self.messages = []; self.image = None; self.success = False; self.output = None
+        self.placement_plan = PlacementPlan(task[9]); self.metrics = StageMetrics() if task[7].get('metrics') else None
+
+    def run_stage(self, stage_func):
+        if self.metrics is None: return stage_func(self)
+        with measuring_stages() as stage_metrics: stage_func(self)
+        self.metrics.merge(stage_metrics)
+
+def _iter_pipeline_stage(pages, stage_func):
+    try:
+        for page in pages: page.run_stage(stage_func); yield page
+    finally: pages.close()
+
+_PIPELINE_END = object()
+
+@contextlib.contextmanager
+def profiling_thread(profile_dir, part_name):
+    # Before Python 3.12 cProfile only sees the thread that enabled it, so run threads profile themselves into a part in
+    # profile_dir that is merged into the run's profile, like the worker processes. Does nothing without profile_dir.
+    profiler = cProfile.Profile() if profile_dir else None
+    try:
+        if profiler: profiler.enable()
+    except ValueError: profiler = None  # Python 3.12+ allows one active profiler, and the run's profiler already sees every thread.
+    try: yield
+    finally:
+        if profiler:
+            profiler.disable(); profile_fd, profile_path = tempfile.mkstemp(prefix=part_name + "_", suffix=".prof", dir=profile_dir); os.close(profile_fd)
+            try: profiler.dump_stats(profile_path)
+            except OSError as e: print(f"Warning: Could not write profile part '{profile_path}': {e}")
+
+def _iter_in_thread(items, depth, thread_name, profile_dir=None):
+    # Runs the items generator on its own thread, at most depth items ahead of the consumer; depth 0 runs it inline.
+    # Errors are re-raised on the consumer side, and closing this generator stops the thread (and the stages before it).
+    if depth <= 0: yield from items; return
+    item_queue = queue.Queue(maxsize=depth); stop_event = threading.Event()
+    def put(item):
+        while not stop_event.is_set():
+            try: item_queue.put(item, timeout=PIPELINE_POLL_SECONDS); return True
+            except queue.Full: pass
+        return False
+    def produce():
+        with profiling_thread(profile_dir, thread_name):
+            try:
+                for item in items:
+                    if not put((item, None)): return
+                put((_PIPELINE_END, None))
+            except BaseException as e: put((_PIPELINE_END, e))
+            finally: items.close()
+    producer_thread = threading.Thread(target=produce, name=thread_name, daemon=True); producer_thread.start()
+    try:
+        while True:
+            item, error = item_queue.get()
+            if item is _PIPELINE_END:
+                if error is not None: raise error
+                return
+            yield item
+    finally: stop_event.set(); producer_thread.join()
+
+def _load_pipeline_page(page):
+    original_file_path, temp_dir, magick_executable_path, _, _, _, _, config, preconverted_png_path, _ = page.task
+    page.image = load_page_image(original_file_path, temp_dir, magick_executable_path, page.messages.append, preconverted_png_path, config.get('psd_reader', "imagemagick"), config.get('magick_transfer', "png"))
+
+def _place_pipeline_page(page):
+    if page.image is None: return
+    page.success = add_watermarks_to_image(page.image, page.task[3], None, page.task[7], page.messages.append, source_copy_path=page.task[0], placement_plan=page.placement_plan)
+
+def _write_pipeline_page(page):
+    original_file_path, _, _, _, output_filename, output_dir, is_zip_mode, config, _, _ = page.task
+    try:
+        if not page.success: return
+        output_final_path, output_target = _output_target_for(output_filename, output_dir, is_zip_mode, config)
+        if output_target is not None: page.success = write_watermarked_output(page.image, len(page.placement_plan.positions), output_target, output_format_for(output_filename), config, page.messages.append, original_file_path)
+        page.success, page.output = _finish_output(output_target, output_final_path, page.success, page.messages.append)
+    finally:
+        if page.image is not None: page.image.close(); page.image = None
+
+def _iter_pipelined_results(files_to_process_in_folder, tasks, status_callback):
+    # Single-process runs overlap the pages: a read-ahead thread loads and decodes up to prefetch_depth pages, a compute
+    # thread searches and pastes, and this thread encodes and writes up to write_depth pages behind it. Logs stay in page order.
+    config = tasks[0][7]; pages = (_PipelinePage(filename, task) for filename, task in zip(files_to_process_in_folder, tasks))
+    loaded_pages = _iter_in_thread(_iter_pipeline_stage(pages, _load_pipeline_page), config.get('prefetch_depth', 0), "awm-read-ahead", config.get('profile_dir'))
+    placed_pages = _iter_in_thread(_iter_pipeline_stage(loaded_pages, _place_pipeline_page), config.get('write_depth', 0), "awm-compute", config.get('profile_dir'))
+    for page in _iter_pipeline_stage(placed_pages, _write_pipeline_page):
+        status_callback(f" >> {page.filename}")
+        for message in page.messages: status_callback(message)
+        yield page.success, page.output, dict(page.metrics.as_dict(), seconds=round(page.metrics.total, 6)) if page.metrics else None, page.placement_plan
+
+def _iter_file_results(files_to_process_in_folder, tasks, process_pool, status_callback, submit_order=None):
+    if process_pool is None and tasks and not tasks[0][7].get('memory_budget') and (tasks[0][7].get('prefetch_depth') or tasks[0][7].get('write_depth')):
+        yield from _iter_pipelined_results(files_to_process_in_folder, tasks, status_callback); return
+    if process_pool is None:
+        for current_filename, task in zip(files_to_process_in_folder, tasks):
+            status_callback(f" >> {current_filename}")
+            yield _run_task(task, status_callback)
+        return
+    for current_filename, result in zip(files_to_process_in_folder, process_pool.map_ordered(_process_file_worker, tasks, submit_order)):
+        status_callback(f" >> {current_filename}")
+        if result is None: status_callback(f"  ! Worker process crashed while processing {current_filename}."); yield False, None, None, None; continue
+        success, output_file_path, messages, file_metrics, placement_plan = result
+        for message in messages: status_callback(message)
+        yield success, output_file_path, file_metrics, placement_plan
+
+def _page_hash(source_path, source_fingerprint=None):
+    if source_fingerprint and source_fingerprint.get("sha256"): return source_fingerprint["sha256"]
+    try: return hash_file(source_path)
+    except OSError: return None
+
+class WorkFolder:
+    # A folder with files to process. relative_path ('/'-separated) is mirrored under the output folder; files are (name, size) pairs.
+    def __init__(self, path, relative_path, files, is_base=False):
+        self.path = path; self.relative_path = relative_path; self.files = files; self.is_base = is_base; self.total_size = sum(size for _, size in files)
+
+def discover_work(base_input_dir, main_output_dir, extensions, watermark_path):
+    # Walks the whole tree with os.scandir, whose entries carry the file type (and on Windows the size) from the directory listing.
+    # Every folder below the base that holds matching files becomes a work folder. Files directly in the base folder are
+    # only processed when there are no such folders, as before.
+    base_input_dir = os.path.abspath(base_input_dir); excluded_paths = {os.path.normcase(os.path.abspath(main_output_dir)), os.path.normcase(os.path.abspath(watermark_path))}
+    # Every directory is recorded by its real path, so a link back to the base, an ancestor or a folder seen before is not walked again.
+    base_real_path = os.path.realpath(base_input_dir); work_folders = []; base_files = []; visited_directories = {os.path.normcase(base_real_path)}; pending_directories = [(base_input_dir, base_real_path, "")]
+    while pending_directories:
+        directory_path, directory_real_path, relative_path = pending_directories.pop(); folder_files = []
+        with os.scandir(directory_path) as entries:
+            for entry in entries:
+                if os.path.normcase(entry.path) in excluded_paths: continue
+                if entry.is_dir():
+                    real_path = os.path.realpath(entry.path) if entry.is_symlink() else os.path.join(directory_real_path, entry.name)
+                    if os.path.normcase(real_path) in visited_directories: continue
+                    visited_directories.add(os.path.normcase(real_path))
+                    pending_directories.append((entry.path, real_path, relative_path + "/" + entry.name if relative_path else entry.name))
+                elif entry.name.lower().endswith(extensions) and entry.is_file(): folder_files.append((entry.name, entry.stat().st_size))
+        folder_files.sort()
+        if not relative_path: base_files = folder_files
+        elif folder_files: work_folders.append(WorkFolder(directory_path, relative_path, folder_files))
+    if not work_folders and base_files: return [WorkFolder(base_input_dir, os.path.basename(base_input_dir), base_files, is_base=True)]
+    return sorted(work_folders, key=lambda work_folder: work_folder.relative_path.split('/'))
+
+def scan_work_folder(base_input_dir, relative_path, extensions, excluded_name=None, is_base=False):
+    # Lists one known work folder with a single os.scandir, for job workers that would otherwise walk the whole tree per job.
+    folder_path = base_input_dir if is_base else os.path.join(base_input_dir, *relative_path.split('/'))
+    with os.scandir(folder_path) as entries:
+        folder_files = sorted((entry.name, entry.stat().st_size) for entry in entries if entry.name.lower().endswith(extensions) and entry.is_file() and entry.name != excluded_name)
+    return WorkFolder(folder_path, relative_path, folder_files, is_base)
+
+def _folder_output_path(main_output_dir, work_folder, config):
+    return os.path.join(main_output_dir, *work_folder.relative_path.split('/')) + (".zip" if config['create_zip'] else "")
+
+def _pending_files(work_folder, output_path, config, manifest):
+    # Returns the source fingerprints, the files whose output is missing or out of date, and how many files were skipped.
+    filenames = [filename for filename, _ in work_folder.files]
+    if not manifest: return {}, filenames, 0
+    source_fingerprints = {filename: manifest.fingerprint(os.path.join(work_folder.path, filename)) for filename in filenames}
+    if config['create_zip']:
+        if os.path.isfile(output_path) and manifest.is_current(manifest.key_for(output_path), source_fingerprints): return source_fingerprints, [], len(filenames)
+        return source_fingerprints, filenames, 0
+    changed_files = []
+    for filename in filenames:
+        output_file_path = os.path.join(output_path, output_filename_for(filename, config))
+        if not (os.path.isfile(output_file_path) and manifest.is_current(manifest.key_for(output_file_path), source_fingerprints[filename])): changed_files.append(filename)
+    return source_fingerprints, changed_files, len(filenames) - len(changed_files)
+
+class SharedPages:
+    # Pages whose source bytes and output format match are watermarked once per run, into a temporary folder under the
+    # output folder, and every copy is hardlinked (or copied, or read into the ZIP) from there. Only pages to process whose
+    # file size occurs more than once are hashed. The first copy in folder order owns the page and is made like any other
+    # page, through the worker pool and batch conversion; later copies wait for it.
+    def __init__(self, main_output_dir, work_folders, config, manifest):
+        self.pending_files = [_pending_files(work_folder, _folder_output_path(main_output_dir, work_folder, config), config, manifest) for work_folder in work_folders]
+        file_size_counts = collections.Counter(size for work_folder, (_, filenames, _) in zip(work_folders, self.pending_files) for filename, size in work_folder.files if filename in filenames)
+        self.page_hashes = {}; occurrences = collections.defaultdict(list)
+        for folder_index, (work_folder, (source_fingerprints, filenames, _)) in enumerate(zip(work_folders, self.pending_files)):
+            file_sizes = dict(work_folder.files)
+            for filename in filenames:
+                if file_size_counts[file_sizes[filename]] < 2: continue
+                page_hash = self.page_hashes[(folder_index, filename)] = _page_hash(os.path.join(work_folder.path, filename), source_fingerprints.get(filename))
+                if page_hash: occurrences[page_hash + os.path.splitext(output_filename_for(filename, config))[1]].append((folder_index, filename))
+        # roles maps each shared page to (shared name, is owner); owner_folders lists the folders whose pages a folder copies.
+        self.roles = {}; self.owner_folders = collections.defaultdict(set); self.entries = {}
+        for shared_name, pages in occurrences.items():
+            if len(pages) < 2: continue
+            self.entries[shared_name] = {"ready": threading.Event(), "path": None, "owner": pages[0][0]}
+            for page_index, (folder_index, filename) in enumerate(pages):
+                self.roles[(folder_index, filename)] = (shared_name, page_index == 0)
+                if folder_index != pages[0][0]: self.owner_folders[folder_index].add(pages[0][0])
+        self.main_output_dir = main_output_dir; self.deduplicated = 0; self._lock = threading.Lock()
+        self.shared_dir = tempfile.mkdtemp(prefix=".awm_shared_", dir=main_output_dir) if self.entries else None
+
+    def role(self, folder_index, filename): return self.roles.get((folder_index, filename))
+
+    def publish(self, shared_name, shared_path):
+        entry = self.entries[shared_name]
+        if not entry["ready"].is_set(): entry["path"] = shared_path; entry["ready"].set()
+
+    def abandon(self, folder_index):
+        # Pages a folder owned but did not finish are marked failed, so the folders copying them make their own.
+        for entry in self.entries.values():
+            if entry["owner"] == folder_index and not entry["ready"].is_set(): entry["ready"].set()
+
+    def wait(self, shared_name):
+        entry = self.entries[shared_name]; entry["ready"].wait(); return entry["path"]
+
+    def count_reuse(self):
+        with self._lock: self.deduplicated += 1
+
+    def cleanup(self):
+        if self.shared_dir: shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+def _link_or_copy(source_path, target_path):
+    try: os.link(source_path, target_path)
+    except OSError: shutil.copyfile(source_path, target_path)
+
+def _reuse_shared_page(task, shared_path, file_metrics, placement_plan, is_owner, status_callback):
+    output_filename, output_dir, is_zip_mode = task[4:7]
+    with measuring_stages() as copy_metrics:
+        with metrics_stage("copy"):
+            try:
+                if is_zip_mode:
+                    with open(shared_path, 'rb') as shared_file: result = True, shared_file.read()
+                else:
+                    output_final_path = os.path.join(output_dir, output_filename); partial_path = partial_output_path(output_final_path, task[7]); _link_or_copy(shared_path, partial_path)
+                    result = publish_partial_output(partial_path, output_final_path, True, status_callback), output_final_path
+            except OSError as e: status_callback(f"  ! Error reusing identical page: {e}"); result = False, None
+    if not task[7].get('metrics'): return result + (None, placement_plan)
+    file_metrics = file_metrics or {"stages": {}, "seconds": 0.0}
+    return result + (dict(file_metrics, stages=dict(file_metrics["stages"], copy=round(copy_metrics.stages["copy"], 6)), seconds=round(file_metrics["seconds"] + copy_metrics.total, 6), deduplicated=not is_owner), placement_plan)
+
+def _iter_with_shared_pages(folder_index, files_to_process_in_folder, tasks, computed_results, prepared_watermark, shared_pages, status_callback):
+    # Owners come out of computed_results with their output in the shared folder; copies wait for it. Name order is kept.
+    computed_results = iter(computed_results)
+    for current_filename, task in zip(files_to_process_in_folder, tasks):
+        role = shared_pages.role(folder_index, current_filename)
+        if role is None: yield next(computed_results); continue
+        shared_name, is_owner = role
+        if is_owner:
+            success, shared_path, file_metrics, placement_plan = next(computed_results); shared_pages.publish(shared_name, shared_path if success else None)
+            yield _reuse_shared_page(task, shared_path, file_metrics, placement_plan, True, status_callback) if success else (False, None, file_metrics, None); continue
+        status_callback(f" >> {current_filename}"); shared_path = shared_pages.wait(shared_name)
+        if shared_path is None: status_callback("  - The identical page failed earlier in this run, processing it again."); yield _run_task(task[:3] + (prepared_watermark,) + task[4:], status_callback); continue
+        shared_pages.count_reuse(); status_callback("  = Identical to another page in this run, reused its output.")
+        yield _reuse_shared_page(task, shared_path, None, None, False, status_callback)
+
+def _process_folder(folder_index, work_folder, total_folders, main_output_dir, prepared_watermark, magick_exe_path, config, process_pool, manifest, run_metrics, placement_cache, stop_event, shared_pages, status_callback, folder_progress_callback):
+    folder_args = (total_folders, main_output_dir, prepared_watermark, magick_exe_path, config, process_pool, manifest, run_metrics, placement_cache, stop_event, shared_pages, status_callback, folder_progress_callback)
+    try:
+        if stop_event is not None and stop_event.is_set(): return 0, 0, 0
+        if run_metrics is None: return _process_folder_files(folder_index, work_folder, *folder_args)
+        with measuring_stages() as folder_metrics: processed_counts = _process_folder_files(folder_index, work_folder, *folder_args)
+        run_metrics.add_folder(folder_index, work_folder.relative_path, processed_counts, folder_metrics)
+        return processed_counts
+    finally:
+        if shared_pages: shared_pages.abandon(folder_index)
+
+def _process_folder_files(folder_index, work_folder, total_folders, main_output_dir, prepared_watermark, magick_exe_path, config, process_pool, manifest, run_metrics, placement_cache, stop_event, shared_pages, status_callback, folder_progress_callback):
+    current_folder_path = work_folder.path; current_folder_name = work_folder.relative_path
+    status_callback(f"\n[{folder_index+1}/{total_folders}] Folder: {current_folder_name}")
+    is_zip_mode = config['create_zip']; zip_file_object = None; plan_only = config.get('plan_only')
+    output_path = _folder_output_path(main_output_dir, work_folder, config)
+    # Archives and new chapter folders are built under a .part name and renamed into place once the chapter is finished.
+    publish_path = partial_output_path(output_path, config) if is_zip_mode or not os.path.isdir(output_path) else output_path
+
+    file_sizes = dict(work_folder.files); number_of_files = len(work_folder.files)
+    source_fingerprints, files_to_process_in_folder, skipped_files = shared_pages.pending_files[folder_index] if shared_pages else _pending_files(work_folder, output_path, config, manifest)
+    if skipped_files: status_callback(f" - Unchanged, skipped {skipped_files} files.")
+    if not files_to_process_in_folder: folder_progress_callback(1.0); return 0, 0, skipped_files
+
+    if is_zip_mode and not plan_only:
+        try: os.makedirs(os.path.dirname(publish_path), exist_ok=True); zip_file_object = zipfile.ZipFile(publish_path, 'w', zipfile.ZIP_DEFLATED)
+        except Exception as zip_create_error: status_callback(f" ! ZIP Error '{output_path}': {zip_create_error}"); return 0, 1, 0
+    elif not plan_only:
+        try: os.makedirs(publish_path, exist_ok=True)
+        except OSError as dir_create_error: status_callback(f" ! Folder Error '{output_path}': {dir_create_error}"); return 0, 1, 0
+
+    number_of_files_to_process = len(files_to_process_in_folder)
+    folder_success_files = 0; folder_error_files = 0; last_processed_file_index = -1; stopped = False
+    try:
+        with tempfile.TemporaryDirectory(prefix="awm_", dir=main_output_dir) as temp_conversion_dir:
+            source_paths = [os.path.join(current_folder_path, current_filename) for current_filename in files_to_process_in_folder]
+            shared_roles = [shared_pages.role(folder_index, current_filename) if shared_pages else None for current_filename in files_to_process_in_folder]
+            known_hashes = shared_pages.page_hashes if shared_pages else {}
+            page_hashes = [known_hashes[(folder_index, current_filename)] if (folder_index, current_filename) in known_hashes else _page_hash(source_path, source_fingerprints.get(current_filename)) if placement_cache else None for source_path, current_filename in zip(source_paths, files_to_process_in_folder)]
+            # Copies of a page owned elsewhere in the run are not converted; they reuse the owner's output.
+            magick_paths = [p for p, shared_role in zip(source_paths, shared_roles) if not (shared_role and not shared_role[1]) and p.lower().endswith(EXTENSIONS_PSD_PSB) and not (config.get('psd_reader') == "auto" and not config.get('memory_budget') and p.lower().endswith(".psd") and pillow_can_read_psd(p))]
+            magick_paths.sort(key=lambda p: file_sizes[os.path.basename(p)], reverse=True)
+            with metrics_stage("batch_convert"): preconverted_paths = batch_convert_to_temp_png(magick_paths, temp_conversion_dir, magick_exe_path, status_callback, config.get('workers', 1)) if len(magick_paths) > 1 and config.get('magick_transfer') != "raw" else {}
+            page_keys = [placement_cache.key_for(page_hash) if placement_cache else None for page_hash in page_hashes]
+            tasks = [(source_path, temp_conversion_dir, magick_exe_path, None if process_pool else prepared_watermark, output_filename_for(current_filename, config), publish_path, is_zip_mode, config, preconverted_paths.get(source_path), placement_cache.lookup(page_key) if placement_cache else None) for source_path, current_filename, page_key in zip(source_paths, files_to_process_in_folder, page_keys)]
+            # Owners of shared pages write into the shared folder; copies are left to _iter_with_shared_pages.
+            computed_indexes = [task_index for task_index, shared_role in enumerate(shared_roles) if not shared_role or shared_role[1]]
+            computed_tasks = [tasks[task_index][:4] + (shared_roles[task_index][0], shared_pages.shared_dir, False) + tasks[task_index][7:] if shared_roles[task_index] else tasks[task_index] for task_index in computed_indexes]
+            # Pages are handed to the workers largest first so a huge PSB does not start last, but results still arrive in name order.
+            submit_order = sorted(range(len(computed_indexes)), key=lambda order_index: file_sizes[files_to_process_in_folder[computed_indexes[order_index]]], reverse=True)
+            file_results = _iter_file_results([files_to_process_in_folder[task_index] for task_index in computed_indexes], computed_tasks, process_pool, status_callback, submit_order)
+            if any(shared_roles): file_results = _iter_with_shared_pages(folder_index, files_to_process_in_folder, tasks, file_results, prepared_watermark, shared_pages, status_callback)
+            for file_index, (watermark_step_success, watermarked_output, file_metrics, placement_plan) in enumerate(file_results):
+                last_processed_file_index = file_index
+                if watermark_step_success and is_zip_mode and zip_file_object:
+                    final_destination_path_or_arcname = tasks[file_index][4]
+                    try:
+                        with metrics_stage("zip_write"): write_zip_entry(zip_file_object, final_destination_path_or_arcname, watermarked_output, config)
+                    except Exception as zip_write_error: status_callback(f"  ! Error adding to ZIP {final_destination_path_or_arcname}: {zip_write_error}"); watermark_step_success = False
+
+                if watermark_step_success: folder_success_files += 1
+                else: folder_error_files += 1
+                if run_metrics: run_metrics.add_file(folder_index, current_folder_name, files_to_process_in_folder[file_index], watermark_step_success, file_metrics)
+                if placement_cache and watermark_step_success and placement_plan and placement_plan.positions is not None: placement_cache.add_page(current_folder_name, files_to_process_in_folder[file_index], page_keys[file_index], placement_plan)
+                if manifest and not is_zip_mode:
+                    output_key = manifest.key_for(os.path.join(output_path, tasks[file_index][4]))
+                    if watermark_step_success: manifest.record(output_key, source_fingerprints[files_to_process_in_folder[file_index]])
+                    else: manifest.forget(output_key)
+
+                folder_progress_callback((skipped_files + file_index + 1) / number_of_files)
+                # A stopped chapter is not published; whoever picks it up next writes it again.
+                if stop_event is not None and stop_event.is_set(): stopped = True; status_callback(f" ! Stopped, leaving {number_of_files_to_process - file_index - 1} files of this folder unprocessed."); break
+    except Exception as folder_processing_error:
+         status_callback(f"! Critical error processing folder {current_folder_name}: {folder_processing_error}")
+         remaining_files = number_of_files_to_process - last_processed_file_index - 1
+         folder_error_files += remaining_files
+
+    log_suffix = f"Success: {folder_success_files}" + (f", Skipped: {skipped_files}" if skipped_files > 0 else "") + (f", Errors: {folder_error_files}" if folder_error_files > 0 else "")
+    status_callback(f"   {log_suffix}")
+    if zip_file_object:
+        zip_is_complete = False
+        try:
+            with metrics_stage("zip_write"): zip_file_object.close()
+            zip_is_complete = folder_error_files < number_of_files and not stopped
+            if not zip_is_complete: status_callback(f" - Removed {'unfinished' if stopped else 'erroneous'} ZIP: {os.path.basename(output_path)}")
+        except Exception as zip_close_error: status_callback(f" ! Error closing ZIP {os.path.basename(output_path)}: {zip_close_error}")
+        publish_partial_output(publish_path, output_path, zip_is_complete, status_callback)
+        if manifest:
+            if folder_error_files == 0 and not stopped and os.path.isfile(output_path): manifest.record(manifest.key_for(output_path), source_fingerprints)
+            else: manifest.forget(manifest.key_for(output_path))
+    elif publish_path != output_path and not plan_only:
+        publish_partial_output(publish_path, output_path, folder_success_files > 0 and not stopped, status_callback)
+        if stopped and manifest:
+            for task in tasks[:last_processed_file_index + 1]: manifest.forget(manifest.key_for(os.path.join(output_path, task[4])))
+    if manifest: manifest.save()
+    return folder_success_files, folder_error_files, skipped_files
+
+def _folder_start_order(work_folders, shared_pages):
+    # Largest chapters first, but never before the chapters owning pages they copy. Owners always come earlier in folder
+    # order, so with the executor starting chapters first in, first out, a chapter only ever waits for one already running.
+    start_order = []; started = set()
+    for folder_index in sorted(range(len(work_folders)), key=lambda folder_index: work_folders[folder_index].total_size, reverse=True):
+        pending_indexes = [folder_index]; chain = []
+        while pending_indexes:
+            index = pending_indexes.pop()
+            if index in started: continue
+            started.add(index); chain.append(index); pending_indexes.extend(shared_pages.owner_folders.get(index, ()) if shared_pages else ())
+        start_order.extend(sorted(chain))
+    return start_order
+
+def _iter_parallel_folder_results(work_folders, folder_args, status_callback, progress_callback):
+    # Several chapters are fed to the shared process pool at once so archive writing overlaps page processing. The largest
+    # chapters are started first. Each chapter logs into its own buffer, which is replayed in folder order to keep the log deterministic.
+    total_folders = len(work_folders); folder_progress = [0.0] * total_folders; progress_lock = threading.Lock()
+    def report_progress(folder_index, value):
+        with progress_lock: folder_progress[folder_index] = value; overall_progress = sum(folder_progress) / total_folders
+        progress_callback(overall_progress)
+    def run_folder(folder_index, work_folder, folder_messages):
+        with profiling_thread(folder_args[4].get('profile_dir'), "awm_folder"): return _process_folder(folder_index, work_folder, *folder_args, folder_messages.append, lambda value: report_progress(folder_index, value))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(PARALLEL_FOLDER_LIMIT, total_folders), thread_name_prefix="awm_folder") as folder_executor:
+        folder_jobs = [None] * total_folders; shared_pages = folder_args[-1]
+        for folder_index in _folder_start_order(work_folders, shared_pages):
+            folder_messages = []; folder_jobs[folder_index] = (folder_executor.submit(run_folder, folder_index, work_folders[folder_index], folder_messages), folder_messages)
+        for folder_future, folder_messages in folder_jobs:
+            try: processed_counts = folder_future.result()
+            except Exception as folder_error: folder_messages.append(f"! Critical error processing folder: {folder_error}"); processed_counts = (0, 1, 0)
+            for message in folder_messages: status_callback(message)
+            yield processed_counts
+
+def _write_profile(profiler, profile_dir, main_output_dir, status_callback):
+    profile_path = os.path.join(main_output_dir, PROFILE_FILENAME)
+    try:
+        profile_stats = pstats.Stats(profiler)
+        for part_name in sorted(os.listdir(profile_dir)): profile_stats.add(os.path.join(profile_dir, part_name))
+        profile_stats.dump_stats(profile_path); status_callback(f"Profile written to {profile_path}")
+    except Exception as e: status_callback(f"! Could not write profile: {e}")
+    finally: shutil.rmtree(profile_dir, ignore_errors=True)
+
+def _run_summary(main_output_dir, total_folders, success_count, error_count, fatal_error=None, skipped_count=0):
+    return {"ok": fatal_error is None and error_count == 0, "output_dir": main_output_dir, "folders": total_folders, "success": success_count, "skipped": skipped_count, "errors": error_count, "fatal_error": fatal_error}
+
+def run_processing(base_input_dir, watermark_path, selected_process_type, magick_executable, config, status_callback=print, progress_callback=None, stdout_to_stderr=False, only_folders=None, work_folders=None, stop_event=None):
+    progress_callback = progress_callback or (lambda value: None)
+    main_output_dir = base_input_dir.rstrip('/\\') + OUTPUT_SUFFIX
+    try: os.makedirs(main_output_dir, exist_ok=True)
+    except OSError as e: fatal_error = f"Critical error creating folder '{main_output_dir}': {e}"; status_callback(f"! {fatal_error}"); return _run_summary(main_output_dir, 0, 0, 0, fatal_error)
+
+    extensions_to_process = EXTENSIONS_PSD_PSB if selected_process_type == "psd" else EXTENSIONS_PNG_JPG
+    magick_exe_path = magick_executable
+
+    run_metrics = RunMetrics() if config.get('metrics') else None
+    try:
+        # Callers that already listed their folders (job workers) pass them in instead of having the whole tree walked.
+        if work_folders is not None: work_folders = [work_folder for work_folder in work_folders if work_folder.files]
+        else:
+            with (run_metrics.stage("scan") if run_metrics else _NO_STAGE): work_folders = discover_work(base_input_dir, main_output_dir, extensions_to_process, watermark_path)
+        if not work_folders: fatal_error = f"No files of type {selected_process_type.upper()} found in folder."; status_callback(f"! {fatal_error}"); return _run_summary(main_output_dir, 0, 0, 0, fatal_error)
+        if work_folders[0].is_base: status_callback(f"Found {len(work_folders[0].files)} files ({selected_process_type.upper()}) in base folder.")
+        else:
+            if only_folders is not None: work_folders = [work_folder for work_folder in work_folders if work_folder.relative_path.split('/')[0] in only_folders]
+            status_callback(f"Found {len(work_folders)} folders with {sum(len(work_folder.files) for work_folder in work_folders)} files ({sum(work_folder.total_size for work_folder in work_folders) / (1024 * 1024):.0f} MB) to process.")
+    except Exception as scan_error: fatal_error = f"Error reading folder '{base_input_dir}': {scan_error}"; status_callback(f"! {fatal_error}"); return _run_summary(main_output_dir, 0, 0, 0, fatal_error)
+
+    total_folders = len(work_folders); total_files_processed_successfully = 0; total_files_with_errors = 0; total_files_skipped = 0
+    try: prepared_watermark = PreparedWatermark.from_path(watermark_path); manifest = RunManifest(main_output_dir, watermark_path, config, selected_process_type) if config.get('incremental') and not config.get('plan_only') else None
+    except Exception as watermark_error: fatal_error = f"Error loading watermark '{watermark_path}': {watermark_error}"; status_callback(f"! {fatal_error}"); return _run_summary(main_output_dir, total_folders, 0, 0, fatal_error)
+    placement_cache = PlacementCache(main_output_dir, prepared_watermark.size, config) if config.get('placement_cache') or config.get('plan_only') else None
+    shared_pages = SharedPages(main_output_dir, work_folders, config, manifest) if config.get('dedup') and not config.get('plan_only') else None
+    worker_count = config.get('workers', 1); process_pool = OrderedProcessPool(worker_count, _init_worker, (prepared_watermark, stdout_to_stderr)) if worker_count > 1 else None
+
+    profiler = None
+    if config.get('profile'):
+        # Worker processes profile their own tasks into profile_dir; the parts are merged into one dump at the end.
+        config = dict(config, profile_dir=tempfile.mkdtemp(prefix="awm_profile_", dir=main_output_dir)); profiler = cProfile.Profile(); profiler.enable()
+    folder_args = (total_folders, main_output_dir, prepared_watermark, magick_exe_path, config, process_pool, manifest, run_metrics, placement_cache, stop_event, shared_pages)
+    try:
+        if process_pool and total_folders > 1: folder_results = _iter_parallel_folder_results(work_folders, folder_args, status_callback, progress_callback)
+        else: folder_results = (_process_folder(folder_index, work_folder, *folder_args, status_callback, lambda value, folder_index=folder_index: progress_callback((folder_index + value) / total_folders)) for folder_index, work_folder in enumerate(work_folders))
+        for processed_counts in folder_results:
+            total_files_processed_successfully += processed_counts[0]; total_files_with_errors += processed_counts[1]; total_files_skipped += processed_counts[2]
+            if stop_event is not None and stop_event.is_set(): break
+    finally:
+        if process_pool: process_pool.shutdown()
+        if manifest: manifest.save()
+        if placement_cache: placement_cache.save()
+        if shared_pages: shared_pages.cleanup()
+        if profiler: profiler.disable(); _write_profile(profiler, config['profile_dir'], main_output_dir, status_callback)
+
+    status_callback(f"\n--- Done. Success: {total_files_processed_successfully}, Skipped: {total_files_skipped}, Errors: {total_files_with_errors} ---")
+    summary = _run_summary(main_output_dir, total_folders, total_files_processed_successfully, total_files_with_errors, skipped_count=total_files_skipped)
+    if placement_cache and placement_cache.hits: status_callback(f"Placement cache: reused the positions of {placement_cache.hits} of {len(placement_cache.pages)} pages.")
+    if shared_pages and shared_pages.deduplicated: status_callback(f"Deduplicated {shared_pages.deduplicated} pages identical to other pages in this run.")
+    if config.get('plan_only'):
+        try: status_callback(f"Plan written to {placement_cache.write_plan(main_output_dir)} (no images were written).")
+        except OSError as e: status_callback(f"! Could not write plan: {e}")
+    if run_metrics:
+        try:
+            report, json_path, csv_path = run_metrics.write_reports(main_output_dir, summary)
+            status_callback(f"Time by stage: {format_stage_totals(report['stages']) or '-'} ({report['candidates']} candidates checked)"); status_callback(f"Metrics written to {json_path} and {os.path.basename(csv_path)}")
+        except OSError as e: status_callback(f"! Could not write metrics report: {e}")
+    progress_callback(1.0)
+    return summary
+
+class FolderWatcher:
+    # Collects the chapter folders touched by file events. Without watchdog, start() returns False and the caller polls instead.
+    def __init__(self, base_input_dir):
+        self.base_input_dir = os.path.abspath(base_input_dir); self._touched = set(); self._lock = threading.Lock(); self._observer = None
+
+    def start(self):
+        watchdog_modules = get_watchdog()
+        if watchdog_modules is None: return False
+        Observer, FileSystemEventHandler = watchdog_modules; folder_watcher = self
+        class ChapterEventHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type in WATCH_IGNORED_EVENTS: return
+                for event_path in (event.src_path, getattr(event, 'dest_path', None)):
+                    if event_path: folder_watcher.touch(event_path)
+        try: self._observer = Observer(); self._observer.schedule(ChapterEventHandler(), self.base_input_dir, recursive=True); self._observer.start(); return True
+        except Exception as e: print(f"Warning: File events are not available, polling instead: {e}"); self._observer = None; return False
+
+    def touch(self, event_path):
+        relative_path = os.path.relpath(os.fsdecode(event_path), self.base_input_dir)
+        if relative_path == os.curdir or relative_path.startswith(os.pardir): return
+        with self._lock: self._touched.add(relative_path.split(os.sep)[0])
+
+    def take_touched(self):
+        with self._lock: touched = self._touched; self._touched = set()
+        return touched
+
+    def stop(self):
+        if self._observer:
+            try: self._observer.stop(); self._observer.join(timeout=5)
+            except Exception as e: print(f"Warning: Could not stop file watcher: {e}")
+
+def folder_signature(folder_path, extensions):
+    # Covers nested volume/chapter folders too; symlinked folders are not followed.
+    signature = []; pending_directories = [(folder_path, "")]
+    while pending_directories:
+        directory_path, relative_path = pending_directories.pop()
+        with os.scandir(directory_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False): pending_directories.append((entry.path, relative_path + entry.name + "/"))
+                elif entry.is_file() and entry.name.lower().endswith(extensions): entry_stat = entry.stat(); signature.append((relative_path + entry.name, entry_stat.st_size, entry_stat.st_mtime_ns))
+    return tuple(sorted(signature))
+
+def _list_chapter_names(base_input_dir, main_output_dir):
+    with os.scandir(base_input_dir) as entries: return {entry.name for entry in entries if entry.is_dir() and entry.path.rstrip('/\\') != main_output_dir}
+
+def watch_folder(base_input_dir, watermark_path, selected_process_type, magick_executable, config, status_callback=print, progress_callback=None, stop_event=None, stdout_to_stderr=False):
+    # Chapters are queued once their file list, sizes and modification times have not changed for watch_settle seconds,
+    # then handed to run_processing together; the manifest skips pages that were already done.
+    stop_event = stop_event or threading.Event(); extensions = EXTENSIONS_PSD_PSB if selected_process_type == "psd" else EXTENSIONS_PNG_JPG
+    main_output_dir = base_input_dir.rstrip('/\\') + OUTPUT_SUFFIX; settle_seconds = config.get('watch_settle', int(DEFAULT_CONFIG["watch_settle"]))
+    folder_watcher = FolderWatcher(base_input_dir); uses_file_events = folder_watcher.start()
+    status_callback(f"Watching {base_input_dir} ({'file events' if uses_file_events else f'polling every {WATCH_POLL_INTERVAL_SECONDS:g}s'}). Chapters are processed after {settle_seconds}s without changes.")
+    processed_signatures = {}; pending_chapters = {}; total_folders = 0; total_success = 0; total_errors = 0; total_skipped = 0; next_full_scan = 0.0
+    try:
+        while not stop_event.is_set():
+            now = time.monotonic(); chapter_names = folder_watcher.take_touched() | set(pending_chapters)
+            if now >= next_full_scan:
+                try: chapter_names |= _list_chapter_names(base_input_dir, main_output_dir) | set(processed_signatures)
+                except OSError as e: status_callback(f"! Error reading folder '{base_input_dir}': {e}")
+                next_full_scan = now + (WATCH_RESCAN_INTERVAL_SECONDS if uses_file_events else WATCH_POLL_INTERVAL_SECONDS)
+            for chapter_name in chapter_names:
+                chapter_path = os.path.join(base_input_dir, chapter_name)
+                try: signature = folder_signature(chapter_path, extensions) if os.path.isdir(chapter_path) else None
+                except OSError: signature = None
+                if signature is None: processed_signatures.pop(chapter_name, None)
+                if not signature or signature == processed_signatures.get(chapter_name): pending_chapters.pop(chapter_name, None)
+                elif chapter_name not in pending_chapters or pending_chapters[chapter_name][0] != signature: pending_chapters[chapter_name] = (signature, now)
+            ready_chapters = sorted(chapter_name for chapter_name, (_, changed_at) in pending_chapters.items() if now - changed_at >= settle_seconds)
+            if ready_chapters:
+                status_callback(f"\n=== {time.strftime('%H:%M:%S')} New or changed: {', '.join(ready_chapters)} ===")
+                summary = run_processing(base_input_dir, watermark_path, selected_process_type, magick_executable, config, status_callback, progress_callback, stdout_to_stderr, only_folders=set(ready_chapters))
+                total_folders += summary["folders"]; total_success += summary["success"]; total_errors += summary["errors"]; total_skipped += summary["skipped"]
+                for chapter_name in ready_chapters: processed_signatures[chapter_name] = pending_chapters.pop(chapter_name)[0]
+                continue
+            next_check = min([changed_at + settle_seconds for _, changed_at in pending_chapters.values()] + [next_full_scan])
+            stop_event.wait(max(0.0, min(next_check - time.monotonic(), WATCH_POLL_INTERVAL_SECONDS)))
+    finally: folder_watcher.stop()
+    status_callback(f"\n--- Watch stopped. Chapters: {total_folders}, Success: {total_success}, Skipped: {total_skipped}, Errors: {total_errors} ---")
+    return _run_summary(main_output_dir, total_folders, total_success, total_errors, skipped_count=total_skipped)
+
+class JobBoard:
+    # A distributed run keeps its jobs in the shared output folder, so workers on every machine that mounts it can split the
+    # chapters. <id>.job describes one work folder, <id>.lock is the lease of the worker processing it (touched as a heartbeat)
+    # and <id>.done holds its result. Leases are created with O_EXCL; a lock that was not touched for the lease time belongs
+    # to a dead worker and is renamed away, which only one worker can do, before the job is claimed again.
+    def __init__(self, main_output_dir):
+        self.jobs_dir = os.path.join(main_output_dir, JOBS_DIRNAME); self.settings_path = os.path.join(self.jobs_dir, JOB_SETTINGS_FILENAME); self._job_records = {}
+
+    def _path(self, job_id, suffix): return os.path.join(self.jobs_dir, job_id + suffix)
+
+    def _read_json(self, path):
+        with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+
+    def _write_json(self, path, data):
+        temp_path = node_temp_path(path)
+        with open(temp_path, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+    def publish(self, work_folders, watermark_path, selected_process_type, config, lease_seconds):
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        # The watermark travels with the jobs, so a worker only needs the input folder.
+        watermark_name = "watermark" + os.path.splitext(watermark_path)[1].lower(); temp_path = node_temp_path(os.path.join(self.jobs_dir, watermark_name))
+        shutil.copyfile(watermark_path, temp_path); os.replace(temp_path, os.path.join(self.jobs_dir, watermark_name))
+        self._write_json(self.settings_path, {"process_type": selected_process_type, "watermark": watermark_name, "lease_seconds": lease_seconds, "config": config})
+        job_ids = set(); watermark_folder = os.path.normcase(os.path.dirname(os.path.abspath(watermark_path)))
+        for work_folder in work_folders:
+            job_id = hashlib.sha256(work_folder.relative_path.encode('utf-8')).hexdigest()[:16]; job_ids.add(job_id)
+            self._write_json(self._path(job_id, ".job"), {"relative_path": work_folder.relative_path, "is_base": work_folder.is_base, "files": len(work_folder.files), "size": work_folder.total_size, "excluded": os.path.basename(watermark_path) if os.path.normcase(os.path.abspath(work_folder.path)) == watermark_folder else None})
+            # A published folder is checked again; the manifest skips its pages that are already done.
+            with contextlib.suppress(FileNotFoundError): os.remove(self._path(job_id, ".done"))
+        for name in os.listdir(self.jobs_dir):
+            job_id, ext = os.path.splitext(name)
+            if ext in (".job", ".done") and job_id not in job_ids:
+                with contextlib.suppress(FileNotFoundError): os.remove(os.path.join(self.jobs_dir, name))
+        return len(job_ids)
+
+    def load_settings(self):
+        try: job_settings = self._read_json(self.settings_path)
+        except FileNotFoundError: raise ValueError(f"No distributed run found in '{self.jobs_dir}'.")
+        except (OSError, ValueError) as e: raise ValueError(f"Could not read job settings '{self.settings_path}': {e}")
+        job_settings['watermark_path'] = os.path.join(self.jobs_dir, job_settings['watermark'])
+        return job_settings
+
+    def _scan(self):
+        jobs = {}; done = {}; locks = {}
+        with os.scandir(self.jobs_dir) as entries:
+            for entry in entries:
+                job_id, ext = os.path.splitext(entry.name)
+                try:
+                    if ext == ".job":
+                        if job_id not in self._job_records: self._job_records[job_id] = self._read_json(entry.path)
+                        jobs[job_id] = self._job_records[job_id]
+                    elif ext == ".done": done[job_id] = self._read_json(entry.path)
+                    elif ext == ".lock": locks[job_id] = entry.stat().st_mtime
+                except (OSError, ValueError): continue
+        return jobs, done, locks
+
+    def _create_lock(self, lock_path, worker_id):
+        token = os.urandom(8).hex()
+        try: lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError: return None
+        with os.fdopen(lock_fd, 'w', encoding='utf-8') as f: json.dump({"worker": worker_id, "token": token, "claimed_at": time.time()}, f)
+        return token
+
+    def _take_expired_lock(self, lock_path, lease_seconds):
+        # Returns the worker whose expired lease was moved away, or None if the lock is live or another worker got there first.
+        try:
+            if time.time() - os.stat(lock_path).st_mtime < lease_seconds: return None
+            expired_path = node_temp_path(lock_path, ".expired"); os.rename(lock_path, expired_path)
+        except OSError: return None
+        try:
+            # Another worker may have taken the job over between the check and the rename; a fresh lock goes back.
+            if time.time() - os.stat(expired_path).st_mtime < lease_seconds:
+                with contextlib.suppress(OSError): os.link(expired_path, lock_path)
+                return None
+            try: return self._read_json(expired_path).get("worker", "?")
+            except (OSError, ValueError): return "?"
+        finally:
+            with contextlib.suppress(OSError): os.remove(expired_path)
+
+    def claim(self, worker_id, lease_seconds):
+        # Returns the largest open job this worker now holds (or None) and how many jobs are not done yet.
+        jobs, done, locks = self._scan(); open_jobs = [(job_id, job) for job_id, job in jobs.items() if job_id not in done]
+        for job_id, job in sorted(open_jobs, key=lambda item: -item[1].get("size", 0)):
+            lock_path = self._path(job_id, ".lock"); previous_worker = None
+            if job_id in locks:
+                previous_worker = self._take_expired_lock(lock_path, lease_seconds)
+                if previous_worker is None: continue
+            token = self._create_lock(lock_path, worker_id)
+            if token is None: continue
+            job = dict(job, id=job_id, token=token, previous_worker=previous_worker)
+            if os.path.exists(self._path(job_id, ".done")): self.release(job); continue
+            return job, len(open_jobs)
+        return None, len(open_jobs)
+
+    def renew(self, job):
+        lock_path = self._path(job['id'], ".lock")
+        try:
+            if self._read_json(lock_path).get("token") != job['token']: return False
+            os.utime(lock_path); return True
+        except (OSError, ValueError): return False
+
+    def release(self, job):
+        lock_path = self._path(job['id'], ".lock")
+        try:
+            if self._read_json(lock_path).get("token") == job['token']: os.remove(lock_path)
+        except (OSError, ValueError): pass
+
+    def complete(self, job, worker_id, summary, seconds):
+        result = {key: summary[key] for key in ("success", "skipped", "errors", "fatal_error")}
+        self._write_json(self._path(job['id'], ".done"), dict(result, relative_path=job['relative_path'], files=job['files'], worker=worker_id, seconds=round(seconds, 3), finished_at=time.time()))
+        self.release(job)
+
+    def status(self):
+        # Merged progress and summary of every worker, read from the job records alone.
+        lease_seconds = self.load_settings()['lease_seconds']; jobs, done, locks = self._scan(); now = time.time()
+        summary = {"jobs": len(jobs), "done": 0, "running": 0, "expired": 0, "pending": 0, "files": 0, "files_done": 0, "success": 0, "skipped": 0, "errors": 0, "failed_jobs": [], "workers": {}}
+        for job_id, job in sorted(jobs.items(), key=lambda item: item[1]['relative_path']):
+            summary["files"] += job['files']; result = done.get(job_id)
+            if result:
+                summary["done"] += 1; summary["files_done"] += job['files']; worker = summary["workers"].setdefault(result['worker'], {"jobs_done": 0, "success": 0, "skipped": 0, "errors": 0, "running": []})
+                worker["jobs_done"] += 1
+                for key in ("success", "skipped", "errors"): summary[key] += result[key]; worker[key] += result[key]
+                if result['fatal_error']: summary["failed_jobs"].append({"relative_path": job['relative_path'], "fatal_error": result['fatal_error']})
+            elif job_id not in locks: summary["pending"] += 1
+            elif now - locks[job_id] >= lease_seconds: summary["expired"] += 1
+            else:
+                summary["running"] += 1
+                try: worker_id = self._read_json(self._path(job_id, ".lock")).get("worker", "?")
+                except (OSError, ValueError): worker_id = "?"
+                summary["workers"].setdefault(worker_id, {"jobs_done": 0, "success": 0, "skipped": 0, "errors": 0, "running": []})["running"].append(job['relative_path'])
+        summary["ok"] = summary["done"] == summary["jobs"] and not summary["errors"] and not summary["failed_jobs"]
+        return dict(summary, jobs_dir=self.jobs_dir, output_dir=os.path.dirname(self.jobs_dir), fatal_error=None)
+
+def distribute_jobs(base_input_dir, watermark_path, selected_process_type, config, lease_seconds=JOB_LEASE_SECONDS, status_callback=print):
+    main_output_dir = base_input_dir.rstrip('/\\') + OUTPUT_SUFFIX; extensions = EXTENSIONS_PSD_PSB if selected_process_type == "psd" else EXTENSIONS_PNG_JPG
+    try:
+        os.makedirs(main_output_dir, exist_ok=True); work_folders = discover_work(base_input_dir, main_output_dir, extensions, watermark_path)
+        if not work_folders: fatal_error = f"No files of type {selected_process_type.upper()} found in folder."; status_callback(f"! {fatal_error}"); return _run_summary(main_output_dir, 0, 0, 0, fatal_error)
+        job_board = JobBoard(main_output_dir); job_count = job_board.publish(work_folders, watermark_path, selected_process_type, config, lease_seconds)
+    except OSError as e: fatal_error = f"Error creating jobs in '{main_output_dir}': {e}"; status_callback(f"! {fatal_error}"); return _run_summary(main_output_dir, 0, 0, 0, fatal_error)
+    status_callback(f"Created {job_count} jobs with {sum(len(work_folder.files) for work_folder in work_folders)} files in {job_board.jobs_dir} (lease {lease_seconds}s).")
+    return job_board.status()
+
+def _renew_lease(job_board, job, lease_seconds, stop_event, lease_lost, status_callback):
+    while not stop_event.wait(lease_seconds / 4):
+        if not job_board.renew(job): lease_lost.set(); status_callback(f"  ! Lost the lease on job '{job['relative_path']}', stopping it; another worker processes it again."); return
+
+def run_job_worker(base_input_dir, magick_executable, status_callback=print, stop_event=None, workers=None, stdout_to_stderr=False):
+    # Claims jobs until every job of the distributed run is done. Jobs held by other workers are waited for, so a surviving
+    # worker retries the jobs of a worker that died once its lease expires.
+    stop_event = stop_event or threading.Event(); main_output_dir = base_input_dir.rstrip('/\\') + OUTPUT_SUFFIX; job_board = JobBoard(main_output_dir)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"; jobs_done = 0; total_folders = 0; total_success = 0; total_errors = 0; total_skipped = 0; waiting_for = None
+    while not stop_event.is_set():
+        try: job_settings = job_board.load_settings(); lease_seconds = job_settings['lease_seconds']; job, open_jobs = job_board.claim(worker_id, lease_seconds)
+        except ValueError as e: status_callback(f"! {e}"); return dict(_run_summary(main_output_dir, total_folders, total_success, total_errors, str(e), total_skipped), worker=worker_id, jobs_done=jobs_done)
+        except OSError as e: status_callback(f"! Could not claim a job: {e}"); stop_event.wait(JOB_POLL_SECONDS); continue
+        if job is None:
+            if not open_jobs: break
+            if waiting_for != open_jobs: status_callback(f"Waiting for {open_jobs} jobs held by other workers..."); waiting_for = open_jobs
+            stop_event.wait(min(JOB_POLL_SECONDS, lease_seconds / 4)); continue
+        waiting_for = None
+        status_callback(f"\n=== {time.strftime('%H:%M:%S')} Job '{job['relative_path']}' ({job['files']} files), worker {worker_id} ===")
+        if job['previous_worker']: status_callback(f"  ! The lease of worker {job['previous_worker']} expired, processing the job again.")
+        config = dict(job_settings['config'], node_partials=True)
+        if workers: config['workers'] = workers
+        # Once the lease is lost the job is stopped after the current page and left to the worker that took it over.
+        lease_stop = threading.Event(); lease_lost = threading.Event(); lease_thread = threading.Thread(target=_renew_lease, args=(job_board, job, lease_seconds, lease_stop, lease_lost, status_callback), name="awm-lease", daemon=True); lease_thread.start()
+        started_at = time.monotonic()
+        try:
+            extensions = EXTENSIONS_PSD_PSB if job_settings['process_type'] == "psd" else EXTENSIONS_PNG_JPG
+            work_folder = scan_work_folder(base_input_dir, job['relative_path'], extensions, job.get('excluded'), job.get('is_base', False))
+            summary = run_processing(base_input_dir, job_settings['watermark_path'], job_settings['process_type'], magick_executable, config, status_callback, stdout_to_stderr=stdout_to_stderr, work_folders=[work_folder], stop_event=lease_lost)
+        except OSError as scan_error: fatal_error = f"Error reading folder '{job['relative_path']}': {scan_error}"; status_callback(f"! {fatal_error}"); summary = _run_summary(main_output_dir, 0, 0, 0, fatal_error)
+        except Exception as job_error: print(f"--- JOB ERROR ({job['relative_path']}) ---\n{traceback.format_exc()}--- END ERROR ---"); summary = _run_summary(main_output_dir, 0, 0, 0, f"Job '{job['relative_path']}' failed: {job_error}")
+        except BaseException: job_board.release(job); raise
+        finally: lease_stop.set(); lease_thread.join()
+        if lease_lost.is_set(): continue
+        try: job_board.complete(job, worker_id, summary, time.monotonic() - started_at)
+        except OSError as e: status_callback(f"! Could not mark job '{job['relative_path']}' as done, it will be retried: {e}")
+        jobs_done += 1; total_folders += summary["folders"]; total_success += summary["success"]; total_errors += summary["errors"]; total_skipped += summary["skipped"]
+    status_callback(f"\n--- Worker {worker_id} finished. Jobs: {jobs_done}, Success: {total_success}, Skipped: {total_skipped}, Errors: {total_errors} ---")
+    return dict(_run_summary(main_output_dir, total_folders, total_success, total_errors, skipped_count=total_skipped), worker=worker_id, jobs_done=jobs_done)